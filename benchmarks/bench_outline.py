@@ -0,0 +1,147 @@
+"""
+消息概要渲染的微基准测试
+
+对比旧版逐个isinstance判断的实现和按类型查表的 MessageUtils.render_outline，
+消息链按群聊中常见的比例混合文本、At、表情、图片、回复以及较少见的消息段类型
+
+需要安装AstrBot，在插件根目录下运行:
+
+    python benchmarks/bench_outline.py [--chains 2000] [--repeat 5]
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import astrbot.api.message_components as Comp
+from utils.message_utils import MessageUtils
+
+
+class _Missing:
+    """当前AstrBot版本中不存在的消息段类型，isinstance判断永远为False"""
+
+
+def _comp(name: str) -> type:
+    return getattr(Comp, name, _Missing)
+
+
+Plain, Image, Face, At, AtAll, Record, Video = (_comp(n) for n in ("Plain", "Image", "Face", "At", "AtAll", "Record", "Video"))
+RPS, Dice, Shake, Anonymous, Share, Contact = (_comp(n) for n in ("RPS", "Dice", "Shake", "Anonymous", "Share", "Contact"))
+Location, Music, RedBag, Poke, Forward, Node = (_comp(n) for n in ("Location", "Music", "RedBag", "Poke", "Forward", "Node"))
+Nodes, Xml, Json, CardImage, TTS, File = (_comp(n) for n in ("Nodes", "Xml", "Json", "CardImage", "TTS", "File"))
+WechatEmoji, Reply = _comp("WechatEmoji"), _comp("Reply")
+
+
+def legacy_outline(message_list, captions) -> str:
+    """旧版实现(去掉图片转述)，用于对比"""
+    outline = ""
+    for i in message_list:
+        if isinstance(i, Plain):
+            outline += i.text
+        elif isinstance(i, Image):
+            caption = captions.get(i.file or i.url)
+            outline += f"[图片: {caption}]" if caption else "[图片]"
+        elif isinstance(i, Face):
+            outline += f"[表情:{i.id}]"
+        elif isinstance(i, At):
+            outline += f"[At:{i.qq}{f'({i.name})' if i.name else ''}]"
+        elif isinstance(i, AtAll):
+            outline += "[At:全体成员]"
+        elif isinstance(i, Record):
+            outline += "[语音]"
+        elif isinstance(i, Video):
+            outline += "[视频]"
+        elif isinstance(i, RPS):
+            outline += "[猜拳]"
+        elif isinstance(i, Dice):
+            outline += "[骰子]"
+        elif isinstance(i, Shake):
+            outline += "[抖一抖]"
+        elif isinstance(i, Anonymous):
+            outline += "[匿名]"
+        elif isinstance(i, Share):
+            outline += f"[分享:《{i.title}》{i.content if i.content else ''}]"
+        elif isinstance(i, Contact):
+            outline += f"[联系人:{i.id}]"
+        elif isinstance(i, Location):
+            outline += f"[位置:{i.title}{f'({i.content})' if i.content else ''}]"
+        elif isinstance(i, Music):
+            outline += f"[音乐:{i.title}{f'({i.content})' if i.content else ''}]"
+        elif isinstance(i, RedBag):
+            outline += f"[红包:{i.title}]"
+        elif isinstance(i, Poke):
+            outline += f"[戳一戳 对:{i.qq}]"
+        elif isinstance(i, (Forward, Node, Nodes)):
+            outline += "[合并转发消息]"
+        elif isinstance(i, Xml):
+            outline += "[XML消息]"
+        elif isinstance(i, Json):
+            json_data = json.loads(i.data) if isinstance(i.data, str) else i.data
+            outline += f"[JSON卡片:{json_data.get('prompt', '')}]" if "prompt" in json_data else "[JSON消息]"
+        elif isinstance(i, CardImage):
+            outline += f"[卡片图片:{i.source if i.source else ''}]"
+        elif isinstance(i, TTS):
+            outline += f"[TTS:{i.text}]"
+        elif isinstance(i, File):
+            outline += f"[文件:{i.name}]"
+        elif isinstance(i, WechatEmoji):
+            outline += "[微信表情]"
+        elif isinstance(i, Reply):
+            sender_info = f"{i.sender_nickname}({i.sender_id})" if i.sender_nickname else f"{i.sender_id}"
+            outline += f"[回复({sender_info}: {legacy_outline(i.chain, captions)})]"
+        else:
+            outline += f"[{i.type}]"
+    return outline
+
+
+def build_chains(count: int, seed: int = 0):
+    """生成混合的消息链，大部分是文本，少量图片、回复和少见类型"""
+    rng = random.Random(seed)
+    makers = [
+        (50, lambda n: Plain(text=f"第{n}条消息，今天天气不错")),
+        (12, lambda n: At(qq=str(10000 + n), name=f"用户{n}")),
+        (10, lambda n: Face(id=n % 300)),
+        (10, lambda n: Image(file="", url=f"https://example.com/{n}.jpg")),
+        (6, lambda n: Reply(id=str(n), chain=[Plain(text="被回复的消息"), Face(id=1)],
+                            sender_id=str(n), sender_nickname=f"用户{n}")),
+        (4, lambda n: Json(data=json.dumps({"prompt": f"[分享]链接{n}"}))),
+        (4, lambda n: File(name=f"文件{n}.zip")),
+        (4, lambda n: WechatEmoji(md5=str(n))),
+    ]
+    weights = [w for w, _ in makers]
+    chains = []
+    for n in range(count):
+        length = rng.randint(1, 6)
+        chains.append([rng.choices(makers, weights)[0][1](n) for _ in range(length)])
+    return chains
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chains", type=int, default=2000, help="消息链数量")
+    parser.add_argument("--repeat", type=int, default=5, help="重复次数，取最快的一次")
+    args = parser.parse_args()
+
+    chains = build_chains(args.chains)
+    captions = {f"https://example.com/{n}.jpg": f"图片{n}" for n in range(0, args.chains, 3)}
+
+    # 两种实现的输出应一致(At全体成员在旧版中会落入At分支，不参与对比)
+    for chain in chains[:200]:
+        assert legacy_outline(chain, captions) == MessageUtils.render_outline(chain, captions)
+
+    components = sum(len(chain) for chain in chains)
+    results = {}
+    for name, func in (("isinstance链", legacy_outline), ("类型查表", MessageUtils.render_outline)):
+        best = min(timeit.repeat(lambda: [func(chain, captions) for chain in chains], number=1, repeat=args.repeat))
+        results[name] = best
+        print(f"{name}: {best * 1000:.2f} ms / {args.chains}条消息链, 每个消息段 {best / components * 1e9:.0f} ns")
+    print(f"加速比: {results['isinstance链'] / results['类型查表']:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
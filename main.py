@@ -17,8 +17,27 @@ class SpectreCore(Star):
         super().__init__(context)
         self.config = config
         # 初始化各个工具类
+        IOExecutor.init(config)
         HistoryStorage.init(config)
+        ImageStorage.init(config)
         ImageCaptionUtils.init(context, config)
+        ReplyDecision.init(config)
+
+    async def terminate(self):
+        """插件卸载时调用，将内存中尚未写入的历史记录落盘喵"""
+        try:
+            await HistoryStorage.shutdown()
+        except Exception as e:
+            logger.error(f"插件卸载时保存历史记录失败: {e}")
+        try:
+            await ImageStorage.shutdown()
+        except Exception as e:
+            logger.error(f"插件卸载时保存图片清单失败: {e}")
+        try:
+            await ImageCaptionUtils.shutdown()
+        except Exception as e:
+            logger.error(f"插件卸载时保存图片描述缓存失败: {e}")
+        IOExecutor.shutdown()
 
     @event_message_type(EventMessageType.GROUP_MESSAGE)
     async def on_group_message(self, event: AstrMessageEvent):
@@ -73,6 +92,9 @@ class SpectreCore(Star):
         """处理大模型回复喵"""
         logger.debug(f"收到大模型回复喵: {resp}")
         try:
+            # 只统计本插件主动回复的token用量，用于每日预算
+            if ReplyScheduler.is_active_reply(event):
+                ReplyScheduler.record_usage(ReplyScheduler.get_token_usage(resp))
             if resp.role != "assistant":
                 return
             # 只进行文本过滤，不处理读空气逻辑
@@ -119,6 +141,7 @@ class SpectreCore(Star):
             "使用reset指令重置当前聊天记录 如/sc reset\n"
             "   你也可以重置指定群聊天记录 如/sc reset 群号\n"
             "使用history指令可以查看最近聊天记录 如/sc history\n"
+            "使用stats指令可以查看回复限流和缓存等运行状态 如/sc stats\n"
             "↓强烈建议您阅读Github中的README文档\n↓"
             "https://github.com/23q3/astrbot_plugin_SpectreCore"
         )
@@ -140,19 +163,16 @@ class SpectreCore(Star):
                 yield event.plain_result("获取聊天ID失败喵，无法显示历史记录")
                 return
                 
-            # 获取历史记录
-            history = HistoryStorage.get_history(platform_name, is_private, chat_id)
-            
-            if not history:
-                yield event.plain_result("暂无聊天记录喵")
-                return
-                
             # 限制记录数量
             if count > 20:
                 count = 20  # 限制最大显示数量为20条
             
-            # 只取最近的记录
-            recent_history = history[-count:] if len(history) > count else history
+            # 只读取最近的记录
+            recent_history = await HistoryStorage.get_history(platform_name, is_private, chat_id, limit=count)
+            
+            if not recent_history:
+                yield event.plain_result("暂无聊天记录喵")
+                return
             
             # 格式化历史记录 
             formatted_history = await MessageUtils.format_history_for_llm(recent_history)
@@ -199,14 +219,14 @@ class SpectreCore(Star):
                     yield event.plain_result("获取聊天ID失败喵，无法重置历史记录")
                     return
             
-            # 先检查是否存在历史记录
-            history = HistoryStorage.get_history(platform_name, is_private, chat_id)
+            # 先检查是否存在历史记录，只需要读取最近一条
+            history = await HistoryStorage.get_history(platform_name, is_private, chat_id, limit=1)
             if not history:
                 yield event.plain_result(f"{chat_type}没有历史记录喵，无需重置")
                 return
                 
             # 重置历史记录
-            success = HistoryStorage.clear_history(platform_name, is_private, chat_id)
+            success = await HistoryStorage.clear_history(platform_name, is_private, chat_id)
             
             if success:
                 yield event.plain_result(f"已成功重置{chat_type}的历史记录喵~")
@@ -217,6 +237,48 @@ class SpectreCore(Star):
             logger.error(f"重置历史记录时发生错误: {e}")
             yield event.plain_result(f"重置历史记录失败喵：{str(e)}")
 
+    @spectrecore.command("stats")
+    async def stats(self, event: AstrMessageEvent):
+        """查看回复限流和缓存等运行状态喵"""
+        try:
+            policy = ReplyDecision.get_policy(self.config)
+            reply_stats = ReplyScheduler.get_stats()
+            budget = policy.daily_token_budget
+            lines = [
+                "SpectreCore运行状态喵：",
+                f"回复: 允许{reply_stats['granted']}次，频率限制{reply_stats['rate_limited']}次，"
+                f"冷却中{reply_stats['cooldown']}次，预算用完{reply_stats['budget_exhausted']}次",
+                f"今日token: {reply_stats['tokens_today']}" + (f"/{budget}" if budget else "（不限）"),
+            ]
+
+            io_stats = IOExecutor.get_stats()
+            lines.append("IO线程池: " + ", ".join(f"{k}={v}" for k, v in io_stats.items()))
+
+            flush_stats = HistoryStorage.get_flush_stats()
+            lines.append(
+                f"历史记录写入: {flush_stats['flushes']}次，共{flush_stats['records']}条，失败{flush_stats['failures']}次，"
+                f"平均耗时{flush_stats['avg_latency_ms']:.1f}ms，待写入聊天{flush_stats['pending_chats']}个"
+            )
+
+            image_stats = ImageStorage.get_stats()
+            lines.append(f"图片存储: {image_stats['images']}张，等待删除{image_stats['pending_deletes']}张")
+
+            cache_stats = ImageCaptionUtils.get_cache_stats()
+            if cache_stats:
+                lookups = cache_stats["hits"] + cache_stats["misses"]
+                hit_rate = cache_stats["hits"] / lookups * 100 if lookups else 0
+                lines.append(
+                    f"图片描述缓存: {cache_stats['entries']}/{cache_stats['max_entries']}条，命中率{hit_rate:.1f}%"
+                )
+
+            ingest_stats = ImageCaptionUtils.get_ingest_stats()
+            lines.append("图片预转述队列: " + ", ".join(f"{k}={v}" for k, v in ingest_stats.items()))
+
+            yield event.plain_result("\n".join(lines))
+        except Exception as e:
+            logger.error(f"获取运行状态时发生错误: {e}")
+            yield event.plain_result(f"获取运行状态失败喵：{str(e)}")
+
     @spectrecore.command("callllm")
     async def callllm(self, event: AstrMessageEvent):
         """触发一次大模型回复 这是用来开发中测试的喵"""
@@ -2,19 +2,44 @@
 工具类模块初始化文件
 """
 
+from .io_executor import IOExecutor
+from .history_record import HistoryRecord
+from .history_backends import HistoryBackend, JsonlHistoryBackend, SqliteHistoryBackend
+from .image_preprocess import ImagePreprocessor
+from .image_index import ImageIndex
+from .image_storage import ImageStorage
 from .history_storage import HistoryStorage
 from .message_utils import MessageUtils
+from .caption_cache import CaptionCache
 from .image_caption import ImageCaptionUtils
 from .llm_utils import LLMUtils
+from .message_rate import MessageRateEstimator
+from .keyword_matcher import KeywordMatch, KeywordMatcher
+from .reply_policy import ReplyPolicy
+from .reply_scheduler import ReplyScheduler
 from .persona_utils import PersonaUtils
 from .text_filter import TextFilter
 from .reply_decision import ReplyDecision
 
 __all__ = [
+    "IOExecutor",
+    "HistoryRecord",
+    "HistoryBackend",
+    "JsonlHistoryBackend",
+    "SqliteHistoryBackend",
+    "ImagePreprocessor",
+    "ImageIndex",
+    "ImageStorage",
     "HistoryStorage",
     "MessageUtils",
+    "CaptionCache",
     "ImageCaptionUtils",
     "LLMUtils",
+    "MessageRateEstimator",
+    "KeywordMatch",
+    "KeywordMatcher",
+    "ReplyPolicy",
+    "ReplyScheduler",
     "PersonaUtils",
     "TextFilter",
     "ReplyDecision"
@@ -0,0 +1,193 @@
+from astrbot.api.all import *
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+import sqlite3
+import threading
+import time
+
+class CaptionCache:
+    """
+    图片描述缓存
+
+    以图片内容哈希为键，内存中按最近使用顺序维护，超过容量时淘汰最久未使用的条目，
+    超过有效期的条目视为未命中
+    所有条目同时保存在SQLite数据库中，重启后无需重新调用大模型转述
+
+    内存操作在事件循环中执行，数据库读写由调用方放到IO线程池中执行
+    """
+
+    def __init__(self, db_path: str, max_entries: int = 2000, ttl: float = 30 * 86400):
+        """
+        Args:
+            db_path: 数据库文件路径
+            max_entries: 最多缓存的图片描述数量
+            ttl: 图片描述的有效期（秒）
+        """
+        self.db_path = db_path
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl
+        # 格式: {key: (caption, 创建时间)}，按最近使用顺序排列
+        self._entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        # 尚未写入数据库的修改
+        self._pending_puts: Dict[str, Tuple[str, float, float]] = {}
+        self._pending_touches: Dict[str, float] = {}
+        self._pending_deletes: Set[str] = set()
+        self._stats: Dict[str, int] = {
+            "hits": 0,       # 命中次数
+            "misses": 0,     # 未命中次数
+            "evictions": 0,  # 因容量淘汰的条目数
+            "expired": 0,    # 因过期删除的条目数
+        }
+
+        # 连接会在IO线程池的多个线程中使用，由锁串行化访问
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS captions ("
+                "key TEXT PRIMARY KEY, "
+                "caption TEXT NOT NULL, "
+                "created REAL NOT NULL, "
+                "last_used REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_captions_last_used ON captions (last_used)")
+            self._conn.commit()
+
+    def load(self) -> int:
+        """
+        从数据库加载最近使用的条目，并删除过期和超出容量的条目
+
+        Returns:
+            加载的条目数量
+        """
+        expire_before = time.time() - self.ttl
+        with self._lock:
+            self._conn.execute("DELETE FROM captions WHERE created < ?", (expire_before,))
+            rows = self._conn.execute(
+                "SELECT key, caption, created, last_used FROM captions ORDER BY last_used DESC LIMIT ?",
+                (self.max_entries,)
+            ).fetchall()
+            if len(rows) == self.max_entries:
+                self._conn.execute("DELETE FROM captions WHERE last_used < ?", (rows[-1][3],))
+            self._conn.commit()
+
+        # 数据库中按最近使用倒序，内存中最久未使用的在前
+        for key, caption, created, _ in reversed(rows):
+            if key not in self._entries:
+                self._entries[key] = (caption, created)
+                self._entries.move_to_end(key, last=False)
+        return len(rows)
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        查询图片描述
+
+        Args:
+            key: 图片内容哈希
+
+        Returns:
+            缓存的图片描述，未命中或已过期时返回None
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self._stats["misses"] += 1
+            return None
+
+        caption, created = entry
+        now = time.time()
+        if now - created > self.ttl:
+            self._remove(key)
+            self._stats["expired"] += 1
+            self._stats["misses"] += 1
+            return None
+
+        self._entries.move_to_end(key)
+        if key not in self._pending_puts:
+            self._pending_touches[key] = now
+        self._stats["hits"] += 1
+        return caption
+
+    def put(self, key: str, caption: str) -> None:
+        """
+        保存图片描述，超出容量时淘汰最久未使用的条目
+
+        Args:
+            key: 图片内容哈希
+            caption: 图片描述
+        """
+        now = time.time()
+        self._entries[key] = (caption, now)
+        self._entries.move_to_end(key)
+        self._pending_puts[key] = (caption, now, now)
+        self._pending_touches.pop(key, None)
+        self._pending_deletes.discard(key)
+
+        while len(self._entries) > self.max_entries:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self._stats["evictions"] += 1
+
+    def _remove(self, key: str) -> None:
+        """从内存中删除条目，并记录待删除的数据库行"""
+        self._entries.pop(key, None)
+        self._pending_puts.pop(key, None)
+        self._pending_touches.pop(key, None)
+        self._pending_deletes.add(key)
+
+    def has_pending(self) -> bool:
+        """是否有尚未写入数据库的修改"""
+        return bool(self._pending_puts or self._pending_touches or self._pending_deletes)
+
+    def drain(self) -> Tuple[Dict[str, Tuple[str, float, float]], Dict[str, float], List[str]]:
+        """
+        取出尚未写入数据库的修改，在事件循环中调用，结果交给write写入
+
+        Returns:
+            (新增的条目, 更新了使用时间的条目, 删除的键)
+        """
+        puts, touches, deletes = self._pending_puts, self._pending_touches, list(self._pending_deletes)
+        self._pending_puts, self._pending_touches, self._pending_deletes = {}, {}, set()
+        return puts, touches, deletes
+
+    def write(self, puts: Dict[str, Tuple[str, float, float]], touches: Dict[str, float], deletes: List[str]) -> None:
+        """
+        在一个事务中写入一批修改
+
+        Args:
+            puts: 新增的条目，格式: {key: (caption, 创建时间, 最后使用时间)}
+            touches: 更新了使用时间的条目，格式: {key: 最后使用时间}
+            deletes: 删除的键
+        """
+        with self._lock:
+            with self._conn:
+                if deletes:
+                    self._conn.executemany("DELETE FROM captions WHERE key = ?", [(key,) for key in deletes])
+                if puts:
+                    self._conn.executemany(
+                        "INSERT OR REPLACE INTO captions (key, caption, created, last_used) VALUES (?, ?, ?, ?)",
+                        [(key, *value) for key, value in puts.items()]
+                    )
+                if touches:
+                    self._conn.executemany(
+                        "UPDATE captions SET last_used = ? WHERE key = ?",
+                        [(ts, key) for key, ts in touches.items()]
+                    )
+
+    def get_stats(self) -> Dict[str, int]:
+        """
+        获取缓存的统计指标
+
+        Returns:
+            统计指标字典，包含条目数、命中、未命中、淘汰次数等
+        """
+        stats = dict(self._stats)
+        stats["entries"] = len(self._entries)
+        stats["max_entries"] = self.max_entries
+        return stats
+
+    def close(self) -> None:
+        """关闭数据库连接"""
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,64 @@
+from contextlib import asynccontextmanager
+from typing import Dict
+import asyncio
+import time
+
+class ChatLockRegistry:
+    """
+    按聊天划分的异步锁注册表
+
+    同一个聊天的读-改-写操作串行执行，不同聊天之间互不影响
+    长时间未使用的锁会被回收，避免锁的数量随聊天数量无限增长
+    """
+
+    def __init__(self, idle_timeout: float = 300):
+        """
+        Args:
+            idle_timeout: 锁空闲多少秒后可以被回收
+        """
+        self.idle_timeout = idle_timeout
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._last_used: Dict[str, float] = {}
+        # 正在持有或等待锁的协程数量，大于0的锁不会被回收
+        self._users: Dict[str, int] = {}
+
+    @asynccontextmanager
+    async def lock(self, chat_key: str):
+        """
+        获取指定聊天的锁
+
+        Args:
+            chat_key: 聊天唯一标识
+        """
+        chat_lock = self._locks.get(chat_key)
+        if chat_lock is None:
+            chat_lock = self._locks[chat_key] = asyncio.Lock()
+        self._users[chat_key] = self._users.get(chat_key, 0) + 1
+        try:
+            async with chat_lock:
+                yield
+        finally:
+            self._users[chat_key] -= 1
+            if self._users[chat_key] <= 0:
+                del self._users[chat_key]
+            self._last_used[chat_key] = time.monotonic()
+
+    def evict_idle(self) -> int:
+        """
+        回收空闲超时的锁
+
+        Returns:
+            回收的锁数量
+        """
+        now = time.monotonic()
+        expired = [
+            chat_key for chat_key, last_used in self._last_used.items()
+            if chat_key not in self._users and now - last_used > self.idle_timeout
+        ]
+        for chat_key in expired:
+            self._locks.pop(chat_key, None)
+            self._last_used.pop(chat_key, None)
+        return len(expired)
+
+    def __len__(self) -> int:
+        return len(self._locks)
@@ -0,0 +1,633 @@
+import os
+import re
+import hashlib
+from abc import ABC, abstractmethod
+import jsonpickle
+from typing import Dict, List, Optional, Set, Tuple
+from astrbot.api.all import *
+import sqlite3
+import threading
+import traceback
+from .history_record import HistoryRecord
+
+# 聊天位置，格式: (platform_name, chat_type, chat_id)，chat_type 为 "group" 或 "private"
+ChatLocation = Tuple[str, str, str]
+
+
+class HistoryBackend(ABC):
+    """
+    历史记录存储后端接口
+
+    所有方法都是阻塞的，由HistoryStorage通过IOExecutor在线程池中调用
+    同一聊天的调用已由HistoryStorage的聊天锁串行化
+    """
+
+    # 每个聊天保留的最大消息数量
+    MAX_HISTORY = 200
+
+    @abstractmethod
+    def load(self, location: ChatLocation, limit: Optional[int] = None) -> List[HistoryRecord]:
+        """
+        读取聊天最近的历史记录
+
+        Args:
+            location: 聊天位置
+            limit: 最多读取的条数，为None时读取全部(最多MAX_HISTORY条)
+
+        Returns:
+            按时间顺序排列的历史记录
+        """
+
+    @abstractmethod
+    def append(self, location: ChatLocation, records: List[HistoryRecord]) -> None:
+        """
+        批量追加历史记录
+
+        Args:
+            location: 聊天位置
+            records: 要追加的历史记录
+        """
+
+    @abstractmethod
+    def clear(self, location: ChatLocation) -> None:
+        """
+        清空聊天的历史记录
+
+        Args:
+            location: 聊天位置
+        """
+
+    def close(self) -> None:
+        """释放后端持有的资源"""
+        pass
+
+
+class JsonlHistoryBackend(HistoryBackend):
+    """
+    日志文件存储后端
+
+    按照平台->聊天类型->ID的层级结构存储消息
+    每个聊天一个只追加的日志文件(.jsonl)，每行是一条精简的HistoryRecord
+    日志行数超过上限后会压缩为最近的MAX_HISTORY条，重写文件时先写临时文件再原子替换
+    """
+
+    # 日志行数达到 MAX_HISTORY * COMPACTION_FACTOR 时执行压缩
+    COMPACTION_FACTOR = 2
+
+    def __init__(self, base_path: str):
+        """
+        Args:
+            base_path: 历史记录根目录
+        """
+        self.base_path = base_path
+        # 已解析的存储路径，格式: {location: file_path}
+        self._path_cache: Dict[ChatLocation, str] = {}
+        # 本次运行中已确保存在的目录
+        self._created_dirs: Set[str] = set()
+        # 日志文件当前行数缓存，格式: {file_path: line_count}
+        self._line_counts: Dict[str, int] = {}
+        # 本次运行中已检查过格式的日志文件
+        self._migrated_paths: Set[str] = set()
+        # 本次运行中已检查过末尾是否完整的日志文件
+        self._checked_tails: Set[str] = set()
+
+    # 路径中允许出现的字符之外的部分都会被替换
+    _UNSAFE_PATH_CHARS = re.compile(r"[^\w\-.@]")
+    # 路径片段的最大长度
+    MAX_NAME_LENGTH = 100
+
+    @staticmethod
+    def sanitize_name(name: str) -> str:
+        """
+        将平台名称或聊天ID转换为安全的路径片段
+
+        只保留字母数字、下划线、-、.和@，不允许以.开头，避免出现路径穿越和隐藏文件
+        名称被修改或截断时追加原名称的哈希，避免不同的ID映射到同一个文件
+        普通的群号、QQ号等不受影响，与已有文件保持兼容
+
+        Args:
+            name: 原始名称
+
+        Returns:
+            安全的路径片段
+        """
+        name = str(name)
+        safe = JsonlHistoryBackend._UNSAFE_PATH_CHARS.sub("_", name).lstrip(".")
+        if safe == name and 0 < len(safe) <= JsonlHistoryBackend.MAX_NAME_LENGTH:
+            return safe
+
+        digest = hashlib.sha1(name.encode("utf-8")).hexdigest()[:8]
+        return f"{safe[:JsonlHistoryBackend.MAX_NAME_LENGTH]}_{digest}"
+
+    def _ensure_dir(self, directory: str) -> None:
+        """确保目录存在，每个目录在本次运行中只检查一次"""
+        if directory in self._created_dirs:
+            return
+        os.makedirs(directory, exist_ok=True)
+        self._created_dirs.add(directory)
+
+    def get_storage_path(self, location: ChatLocation) -> str:
+        """
+        获取存储路径
+
+        解析结果会被缓存，重复调用时不做任何文件系统操作
+        """
+        file_path = self._path_cache.get(location)
+        if file_path is not None:
+            return file_path
+
+        platform_name, chat_type, chat_id = location
+        directory = os.path.join(self.base_path, self.sanitize_name(platform_name), chat_type)
+
+        self._ensure_dir(directory)
+        file_path = os.path.join(directory, f"{self.sanitize_name(chat_id)}.jsonl")
+        self._path_cache[location] = file_path
+        return file_path
+
+    @staticmethod
+    def _convert_legacy_message(message: AstrBotMessage) -> HistoryRecord:
+        """将jsonpickle还原的AstrBotMessage转换为HistoryRecord"""
+        if isinstance(message, HistoryRecord):
+            return message
+        return HistoryRecord.from_message(message)
+
+    def _get_legacy_paths(self, location: ChatLocation, file_path: str) -> List[str]:
+        """
+        获取旧版整文件JSON可能存在的路径
+
+        Args:
+            location: 聊天位置
+            file_path: 日志文件路径(.jsonl)
+
+        Returns:
+            旧版文件路径列表
+        """
+        paths = [file_path[:-len(".jsonl")] + ".json"]
+
+        # 旧版直接使用原始名称作为路径，名称被 sanitize_name 修改过时旧版文件仍在原始路径上
+        platform_name, chat_type, chat_id = location
+        raw_dir = os.path.join(self.base_path, str(platform_name), chat_type)
+        raw_path = os.path.join(raw_dir, f"{chat_id}.json")
+        if raw_path not in paths:
+            # 只接受位于历史记录根目录下对应聊天类型目录中的路径，避免路径穿越
+            real_dir = os.path.realpath(raw_dir)
+            if (real_dir.startswith(os.path.realpath(self.base_path) + os.sep)
+                    and os.path.dirname(os.path.realpath(raw_path)) == real_dir):
+                paths.append(raw_path)
+        return paths
+
+    def _read_legacy_history(self, file_path: str, legacy_paths: List[str]) -> Optional[List[HistoryRecord]]:
+        """
+        读取旧版格式的历史记录，不修改任何文件
+
+        支持两种旧版格式：
+        - 整文件JSON(.json)，内容为jsonpickle序列化的AstrBotMessage列表
+        - 每行一条jsonpickle序列化AstrBotMessage的日志(.jsonl)
+
+        Args:
+            file_path: 日志文件路径(.jsonl)
+            legacy_paths: 旧版整文件JSON可能存在的路径
+
+        Returns:
+            最近的MAX_HISTORY条历史记录，不是旧版格式时返回None
+        """
+        history = None
+        if os.path.exists(file_path):
+            lines = self._read_journal_lines(file_path)
+            # jsonpickle格式的行带有py/object标记
+            if lines and '"py/object"' in lines[0]:
+                history = [jsonpickle.decode(line) for line in lines]
+        else:
+            for legacy_path in legacy_paths:
+                if os.path.exists(legacy_path):
+                    with open(legacy_path, "r", encoding="utf-8") as f:
+                        history = jsonpickle.decode(f.read()) or []
+                    break
+
+        if history is None:
+            return None
+        return [self._convert_legacy_message(msg) for msg in history[-self.MAX_HISTORY:]]
+
+    def _migrate_legacy_file(self, location: ChatLocation, file_path: str) -> None:
+        """
+        将旧版格式的历史记录迁移为精简的日志格式，并删除旧版文件
+
+        每个文件在本次运行中只检查一次
+
+        Args:
+            location: 聊天位置
+            file_path: 日志文件路径(.jsonl)
+        """
+        if file_path in self._migrated_paths:
+            return
+
+        legacy_paths = self._get_legacy_paths(location, file_path)
+        try:
+            records = self._read_legacy_history(file_path, legacy_paths)
+            if records is not None:
+                lines = [record.encode() + "\n" for record in records]
+                self._atomic_write_lines(file_path, lines)
+                self._line_counts[file_path] = len(lines)
+                logger.info(f"已将历史记录迁移为精简日志格式: {file_path}")
+
+            for legacy_path in legacy_paths:
+                if os.path.exists(legacy_path):
+                    os.remove(legacy_path)
+            self._migrated_paths.add(file_path)
+        except Exception as e:
+            logger.error(f"迁移旧版历史记录失败 {file_path}: {e}")
+            logger.debug(traceback.format_exc())
+
+    @staticmethod
+    def _atomic_write_lines(file_path: str, lines: List[str]) -> None:
+        """
+        原子地重写文件：先写入临时文件并落盘，再替换原文件
+
+        写入过程中崩溃只会留下临时文件，原文件保持完整
+
+        Args:
+            file_path: 目标文件路径
+            lines: 要写入的行
+        """
+        temp_path = f"{file_path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.writelines(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, file_path)
+
+    @staticmethod
+    def _read_journal_lines(file_path: str) -> List[str]:
+        """
+        读取日志文件中的所有非空行
+
+        Args:
+            file_path: 日志文件路径
+
+        Returns:
+            日志行列表
+        """
+        if not os.path.exists(file_path):
+            return []
+
+        with open(file_path, "r", encoding="utf-8") as f:
+            return [line for line in f if line.strip()]
+
+    @staticmethod
+    def _read_tail_lines(file_path: str, count: int, block_size: int = 65536) -> List[str]:
+        """
+        从文件末尾向前分块读取最后count个非空行，不读取文件的其余部分
+
+        Args:
+            file_path: 日志文件路径
+            count: 需要的行数
+            block_size: 每次向前读取的字节数
+
+        Returns:
+            日志行列表
+        """
+        if count <= 0 or not os.path.exists(file_path):
+            return []
+
+        with open(file_path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            position = f.tell()
+            lines: List[bytes] = []
+            data = b""
+            while position > 0 and len(lines) < count:
+                read_size = min(block_size, position)
+                position -= read_size
+                f.seek(position)
+                data = f.read(read_size) + data
+                segments = data.split(b"\n")
+                if position > 0:
+                    # 没有读到文件开头时，第一段可能是被截断的行，读到的位置恰好是行首时第一段为空
+                    segments = segments[1:]
+                lines = [line for line in segments if line.strip()]
+
+        return [line.decode("utf-8") for line in lines[-count:]]
+
+    @staticmethod
+    def _truncate_torn_tail(file_path: str, block_size: int = 65536) -> bool:
+        """
+        截掉日志文件末尾不完整的行
+
+        追加过程中崩溃可能留下没有换行符的最后一行，直接追加会把新记录接在这一行后面，
+        导致新记录也无法解析
+
+        Args:
+            file_path: 日志文件路径
+            block_size: 每次向前读取的字节数
+
+        Returns:
+            是否截掉了不完整的行
+        """
+        if not os.path.exists(file_path):
+            return False
+
+        with open(file_path, "rb+") as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size == 0:
+                return False
+            f.seek(size - 1)
+            if f.read(1) == b"\n":
+                return False
+
+            # 向前查找最后一个换行符，截掉之后的部分
+            position = size
+            end = 0
+            while position > 0:
+                read_size = min(block_size, position)
+                position -= read_size
+                f.seek(position)
+                index = f.read(read_size).rfind(b"\n")
+                if index >= 0:
+                    end = position + index + 1
+                    break
+            f.truncate(end)
+        return True
+
+    def _get_line_count(self, file_path: str) -> int:
+        """获取日志文件行数，首次访问时从文件统计"""
+        count = self._line_counts.get(file_path)
+        if count is None:
+            count = len(self._read_journal_lines(file_path))
+            self._line_counts[file_path] = count
+        return count
+
+    def _compact(self, file_path: str) -> None:
+        """
+        压缩日志文件，只保留最近的MAX_HISTORY条消息
+
+        压缩时直接截取原始行，不需要反序列化
+
+        Args:
+            file_path: 日志文件路径
+        """
+        lines = self._read_journal_lines(file_path)[-self.MAX_HISTORY:]
+        self._atomic_write_lines(file_path, lines)
+        self._line_counts[file_path] = len(lines)
+        logger.debug(f"已压缩历史记录日志: {file_path}，保留{len(lines)}条")
+
+    def _decode_lines(self, file_path: str, lines: List[str]) -> List[HistoryRecord]:
+        """逐行解码日志，跳过无法解析的行"""
+        records = []
+        for line in lines:
+            try:
+                records.append(HistoryRecord.decode(line))
+            except ValueError:
+                # 追加过程中崩溃可能留下不完整的最后一行
+                logger.warning(f"跳过无法解析的历史记录行: {file_path}")
+        return records
+
+    def load(self, location: ChatLocation, limit: Optional[int] = None) -> List[HistoryRecord]:
+        file_path = self.get_storage_path(location)
+        self._migrate_legacy_file(location, file_path)
+
+        count = self.MAX_HISTORY if limit is None else min(limit, self.MAX_HISTORY)
+        if count < self.MAX_HISTORY:
+            # 只需要最近几条时从文件末尾读取，不读取和解码其余的行
+            lines = self._read_tail_lines(file_path, count)
+        else:
+            lines = self._read_journal_lines(file_path)
+            self._line_counts[file_path] = len(lines)
+
+        # 逐行解码，只保留最近的count条
+        return self._decode_lines(file_path, lines[-count:] if count > 0 else [])
+
+    def read_all(self, location: ChatLocation) -> List[HistoryRecord]:
+        """
+        读取聊天最近的MAX_HISTORY条历史记录，兼容旧版格式
+
+        不迁移、不删除任何文件，用于导入到其他存储后端
+
+        Args:
+            location: 聊天位置
+
+        Returns:
+            按时间顺序排列的历史记录
+        """
+        file_path = self.get_storage_path(location)
+        records = self._read_legacy_history(file_path, self._get_legacy_paths(location, file_path))
+        if records is not None:
+            return records
+        return self._decode_lines(file_path, self._read_journal_lines(file_path)[-self.MAX_HISTORY:])
+
+    def append(self, location: ChatLocation, records: List[HistoryRecord]) -> None:
+        file_path = self.get_storage_path(location)
+        self._migrate_legacy_file(location, file_path)
+        # 每个文件在本次运行中首次追加前检查一次末尾
+        if file_path not in self._checked_tails:
+            if self._truncate_torn_tail(file_path):
+                logger.warning(f"已截掉历史记录日志末尾不完整的行: {file_path}")
+                self._line_counts.pop(file_path, None)
+            self._checked_tails.add(file_path)
+        line_count = self._get_line_count(file_path)
+
+        # 每条记录编码为单行JSON
+        lines = [record.encode() + "\n" for record in records]
+        with open(file_path, "a", encoding="utf-8") as f:
+            f.writelines(lines)
+        line_count += len(lines)
+        self._line_counts[file_path] = line_count
+
+        if line_count >= self.MAX_HISTORY * self.COMPACTION_FACTOR:
+            self._compact(file_path)
+
+    def clear(self, location: ChatLocation) -> None:
+        # 同时删除日志文件和尚未迁移的旧版文件
+        file_path = self.get_storage_path(location)
+        for path in [file_path, *self._get_legacy_paths(location, file_path)]:
+            if os.path.exists(path):
+                os.remove(path)
+        self._line_counts.pop(file_path, None)
+
+    # sanitize_name 修改过的名称末尾带有原名称的哈希
+    _HASHED_NAME = re.compile(r"_[0-9a-f]{8}$")
+
+    def _is_original_name(self, name: str) -> bool:
+        """
+        判断磁盘上的文件或目录名是否就是原始的平台名称或聊天ID
+
+        被 sanitize_name 修改过的名称无法还原出原始ID，按这样的名称读写会对应到另一个聊天
+        """
+        return not (self.sanitize_name(name) == name and self._HASHED_NAME.search(name))
+
+    def iter_locations(self) -> List[ChatLocation]:
+        """
+        列出磁盘上所有存在历史记录的聊天
+
+        名称被 sanitize_name 修改过的聊天无法得知原始ID，不会被列出
+        """
+        locations = set()
+        if not os.path.isdir(self.base_path):
+            return []
+        for platform_name in os.listdir(self.base_path):
+            if not self._is_original_name(platform_name):
+                logger.warning(f"无法还原平台名称，跳过: {platform_name}")
+                continue
+            for chat_type in ("group", "private"):
+                directory = os.path.join(self.base_path, platform_name, chat_type)
+                if not os.path.isdir(directory):
+                    continue
+                for filename in os.listdir(directory):
+                    chat_id, ext = os.path.splitext(filename)
+                    if ext not in (".jsonl", ".json"):
+                        continue
+                    if not self._is_original_name(chat_id):
+                        logger.warning(f"无法还原聊天ID，跳过: {os.path.join(directory, filename)}")
+                        continue
+                    locations.add((platform_name, chat_type, chat_id))
+        return sorted(locations)
+
+
+class SqliteHistoryBackend(HistoryBackend):
+    """
+    SQLite存储后端
+
+    所有聊天存储在同一个数据库中，使用WAL模式提高并发读写性能
+    按(平台, 聊天类型, 聊天ID, 时间戳)建立索引，读取最近N条时只查询N行
+    """
+
+    # 单个聊天的行数达到 MAX_HISTORY * TRIM_FACTOR 时删除较早的记录
+    TRIM_FACTOR = 2
+
+    def __init__(self, db_path: str):
+        """
+        Args:
+            db_path: 数据库文件路径
+        """
+        self.db_path = db_path
+        # 连接会在IO线程池的多个线程中使用，由锁串行化访问
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        # 各聊天当前行数缓存，格式: {location: row_count}
+        self._row_counts: Dict[ChatLocation, int] = {}
+
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS history ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "platform TEXT NOT NULL, "
+                "chat_type TEXT NOT NULL, "
+                "chat_id TEXT NOT NULL, "
+                "timestamp INTEGER NOT NULL, "
+                "data TEXT NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_history_chat "
+                "ON history (platform, chat_type, chat_id, timestamp)"
+            )
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self._conn.commit()
+
+    def load(self, location: ChatLocation, limit: Optional[int] = None) -> List[HistoryRecord]:
+        count = self.MAX_HISTORY if limit is None else min(limit, self.MAX_HISTORY)
+        if count <= 0:
+            return []
+
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT data FROM history WHERE platform = ? AND chat_type = ? AND chat_id = ? "
+                "ORDER BY timestamp DESC, id DESC LIMIT ?",
+                (*location, count)
+            ).fetchall()
+
+        records = []
+        for (data,) in reversed(rows):
+            try:
+                records.append(HistoryRecord.decode(data))
+            except ValueError:
+                logger.warning(f"跳过无法解析的历史记录: {location}")
+        return records
+
+    def _get_row_count(self, location: ChatLocation) -> int:
+        """获取聊天的行数，首次访问时从数据库统计，调用方需持有锁"""
+        count = self._row_counts.get(location)
+        if count is None:
+            count = self._conn.execute(
+                "SELECT COUNT(*) FROM history WHERE platform = ? AND chat_type = ? AND chat_id = ?",
+                location
+            ).fetchone()[0]
+            self._row_counts[location] = count
+        return count
+
+    def append(self, location: ChatLocation, records: List[HistoryRecord]) -> None:
+        if not records:
+            return
+
+        rows = [(*location, record.timestamp, record.encode()) for record in records]
+        with self._lock:
+            row_count = self._get_row_count(location)
+            # 批量插入，整批在一个事务中提交
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT INTO history (platform, chat_type, chat_id, timestamp, data) VALUES (?, ?, ?, ?, ?)",
+                    rows
+                )
+                row_count += len(rows)
+
+                if row_count >= self.MAX_HISTORY * self.TRIM_FACTOR:
+                    self._conn.execute(
+                        "DELETE FROM history WHERE platform = ? AND chat_type = ? AND chat_id = ? AND id NOT IN ("
+                        "SELECT id FROM history WHERE platform = ? AND chat_type = ? AND chat_id = ? "
+                        "ORDER BY timestamp DESC, id DESC LIMIT ?)",
+                        (*location, *location, self.MAX_HISTORY)
+                    )
+                    row_count = min(row_count, self.MAX_HISTORY)
+            self._row_counts[location] = row_count
+
+    def clear(self, location: ChatLocation) -> None:
+        with self._lock:
+            with self._conn:
+                self._conn.execute(
+                    "DELETE FROM history WHERE platform = ? AND chat_type = ? AND chat_id = ?",
+                    location
+                )
+            self._row_counts[location] = 0
+
+    def import_from_jsonl(self, source: JsonlHistoryBackend) -> int:
+        """
+        一次性导入日志文件中的历史记录
+
+        导入完成后在数据库中记录标记，之后不会重复导入，原文件保留不删除
+
+        Args:
+            source: 日志文件存储后端
+
+        Returns:
+            导入的聊天数量，已导入过时返回0
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = 'jsonl_imported'").fetchone()
+        if row:
+            return 0
+
+        imported = 0
+        for location in source.iter_locations():
+            try:
+                # 只读取不迁移，原文件保留不变
+                records = source.read_all(location)
+                if not records:
+                    continue
+                with self._lock:
+                    if self._get_row_count(location) > 0:
+                        # 数据库中已有该聊天的记录，不覆盖
+                        continue
+                self.append(location, records)
+                imported += 1
+            except Exception as e:
+                logger.error(f"导入历史记录失败 {location}: {e}")
+
+        with self._lock:
+            with self._conn:
+                self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('jsonl_imported', '1')")
+        logger.info(f"已将{imported}个聊天的历史记录导入SQLite数据库")
+        return imported
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,155 @@
+from astrbot.api.all import *
+import astrbot.api.message_components as Comp
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Any, Dict, List, Optional
+import json
+
+# 消息段序列化后用于标记类型的键，字段名不会以下划线开头，因此不会冲突
+COMPONENT_TYPE_KEY = "_type"
+
+
+@dataclass(slots=True)
+class HistoryRecord:
+    """
+    历史消息记录
+
+    只保存格式化历史记录所需的字段，代替完整的AstrBotMessage对象图
+    消息段以精简的字典保存，省略空值字段，需要时再还原为消息段对象
+    """
+
+    message_id: str = ""
+    sender_id: str = ""
+    sender_nickname: str = ""
+    timestamp: int = 0
+    message_str: str = ""
+    # 精简的消息段列表，格式: [{"_type": "Plain", "text": "..."}, ...]
+    components: List[Dict[str, Any]] = field(default_factory=list)
+    # 还原后的消息段对象缓存，不参与序列化
+    _message: Optional[List[BaseMessageComponent]] = field(default=None, init=False, repr=False, compare=False)
+    # 渲染后的消息概要缓存，由MessageUtils在内容完整时写入，不参与序列化
+    outline: Optional[str] = field(default=None, init=False, repr=False, compare=False)
+    # 格式化后的消息片段缓存(发送者、时间和概要)，不参与序列化
+    segment: Optional[str] = field(default=None, init=False, repr=False, compare=False)
+
+    @staticmethod
+    def from_message(message: AstrBotMessage) -> "HistoryRecord":
+        """
+        从AstrBotMessage创建历史记录
+
+        Args:
+            message: AstrBot消息对象
+
+        Returns:
+            历史消息记录
+        """
+        sender = getattr(message, "sender", None)
+        chain = getattr(message, "message", None) or []
+        return HistoryRecord(
+            message_id=str(getattr(message, "message_id", "") or ""),
+            sender_id=str(getattr(sender, "user_id", "") or "") if sender else "",
+            sender_nickname=(getattr(sender, "nickname", "") or "") if sender else "",
+            timestamp=int(getattr(message, "timestamp", 0) or 0),
+            message_str=getattr(message, "message_str", "") or "",
+            components=[_encode_component(comp) for comp in chain],
+        )
+
+    @property
+    def message(self) -> List[BaseMessageComponent]:
+        """还原后的消息段列表，首次访问时构建"""
+        if self._message is None:
+            self._message = [_decode_component(data) for data in self.components]
+        return self._message
+
+    def to_dict(self) -> Dict[str, Any]:
+        """转换为精简的字典，省略空值字段"""
+        data = {"id": self.message_id, "uid": self.sender_id, "nick": self.sender_nickname,
+                "ts": self.timestamp, "text": self.message_str, "c": self.components}
+        return {k: v for k, v in data.items() if v}
+
+    @staticmethod
+    def from_dict(data: Dict[str, Any]) -> "HistoryRecord":
+        """从精简的字典创建历史记录"""
+        return HistoryRecord(
+            message_id=data.get("id", ""),
+            sender_id=data.get("uid", ""),
+            sender_nickname=data.get("nick", ""),
+            timestamp=data.get("ts", 0),
+            message_str=data.get("text", ""),
+            components=data.get("c", []),
+        )
+
+    def encode(self) -> str:
+        """编码为单行JSON"""
+        return json.dumps(self.to_dict(), ensure_ascii=False, separators=(",", ":"))
+
+    @staticmethod
+    def decode(line: str) -> "HistoryRecord":
+        """从单行JSON解码"""
+        return HistoryRecord.from_dict(json.loads(line))
+
+
+def _encode_value(value: Any) -> Any:
+    """将消息段的字段值转换为可JSON序列化的值"""
+    if isinstance(value, BaseMessageComponent):
+        return _encode_component(value)
+    if isinstance(value, Enum):
+        return value.value
+    if isinstance(value, (list, tuple)):
+        return [_encode_value(v) for v in value]
+    if isinstance(value, dict):
+        return {str(k): _encode_value(v) for k, v in value.items()}
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return str(value)
+
+
+def _encode_component(comp: BaseMessageComponent) -> Dict[str, Any]:
+    """
+    将消息段编码为精简的字典
+
+    只保留非空字段，嵌套的消息段(如回复中的消息链)会递归编码
+    """
+    data = {COMPONENT_TYPE_KEY: type(comp).__name__}
+    for key, value in vars(comp).items():
+        if key == "type" or key.startswith("_"):
+            continue
+        if value is None or value == "" or value == [] or value == {}:
+            continue
+        data[key] = _encode_value(value)
+    return data
+
+
+def _decode_value(value: Any) -> Any:
+    """还原字段值，遇到带类型标记的字典时还原为消息段"""
+    if isinstance(value, list):
+        return [_decode_value(v) for v in value]
+    if isinstance(value, dict):
+        if COMPONENT_TYPE_KEY in value:
+            return _decode_component(value)
+        return {k: _decode_value(v) for k, v in value.items()}
+    return value
+
+
+def _decode_component(data: Dict[str, Any]) -> BaseMessageComponent:
+    """
+    将精简的字典还原为消息段对象
+
+    与jsonpickle一致，不经过构造函数校验，缺省字段使用默认值
+    """
+    type_name = data.get(COMPONENT_TYPE_KEY, "")
+    fields = {k: _decode_value(v) for k, v in data.items() if k != COMPONENT_TYPE_KEY}
+
+    cls = getattr(Comp, type_name, None)
+    if not (isinstance(cls, type) and issubclass(cls, BaseMessageComponent)):
+        logger.debug(f"未知的消息段类型: {type_name}，使用占位文本代替")
+        return Plain(text=f"[{type_name}]")
+
+    try:
+        construct = getattr(cls, "model_construct", None) or getattr(cls, "construct", None)
+        if construct:
+            return construct(**fields)
+        return cls(**fields)
+    except Exception as e:
+        logger.debug(f"还原消息段 {type_name} 失败: {e}")
+        return Plain(text=f"[{type_name}]")
@@ -1,22 +1,70 @@
 import os
-import jsonpickle
-from typing import List
+from typing import Dict, List, Optional, Set
+from collections import OrderedDict, deque
 from astrbot.api.all import *
+import asyncio
+import itertools
 import time
 import traceback
+from .io_executor import IOExecutor
+from .history_record import HistoryRecord
+from .chat_lock import ChatLockRegistry
+from .image_storage import ImageStorage
+from .image_caption import ImageCaptionUtils
+from .message_utils import MessageUtils
+from .history_backends import ChatLocation, HistoryBackend, JsonlHistoryBackend, SqliteHistoryBackend
 
 class HistoryStorage:
     """
     历史消息存储工具类
     
-    按照平台->聊天类型->ID的层级结构存储消息
-    使用jsonpickle序列化AstrBotMessage对象为JSON格式
+    按照平台->聊天类型->ID的层级结构存储消息，实际读写由可切换的存储后端完成：
+    - json: 每个聊天一个只追加的日志文件(.jsonl)
+    - sqlite: 所有聊天存储在同一个WAL模式的SQLite数据库中
+    
+    最近活跃的聊天会常驻内存(按LRU淘汰)，读取直接从内存返回，
+    新消息先写入内存并进入待写入队列，攒够一批或等待一小段时间后合并为一次写入
+    所有磁盘操作都通过IOExecutor在线程池中执行，不阻塞事件循环
+    同一聊天的读写通过聊天锁串行执行
     """
     
     # 保存配置对象的静态变量
     config = None
     # 基础存储路径
     base_storage_path = None
+    # 每个聊天保留的最大消息数量
+    MAX_HISTORY = HistoryBackend.MAX_HISTORY
+    # 存储后端
+    _backend: Optional[HistoryBackend] = None
+    # 存储后端是否已完成初始化(如一次性导入旧数据)
+    _backend_ready = False
+    _backend_ready_lock: Optional[asyncio.Lock] = None
+    
+    # 常驻内存的历史记录，按最近访问顺序排列，格式: {chat_key: deque([HistoryRecord, ...])}
+    _cache: "OrderedDict[str, deque]" = OrderedDict()
+    # 聊天对应的存储位置，格式: {chat_key: (platform_name, chat_type, chat_id)}
+    _chat_locations: Dict[str, ChatLocation] = {}
+    # 尚未写入磁盘的消息，格式: {chat_key: [HistoryRecord, ...]}
+    _pending: Dict[str, List[HistoryRecord]] = {}
+    # 有未写入消息的聊天
+    _dirty: Set[str] = set()
+    # 后台维护任务：定期重试写入失败的消息并回收空闲锁
+    _flush_task: Optional[asyncio.Task] = None
+    # 已调度合并写入的聊天，格式: {chat_key: asyncio.Event}，事件被设置时立即写入
+    _flush_waiters: Dict[str, asyncio.Event] = {}
+    # 正在等待或执行中的合并写入任务
+    _flush_tasks: Set[asyncio.Task] = set()
+    # 合并写入统计
+    _flush_stats: Dict[str, float] = {
+        "flushes": 0,          # 写入次数
+        "records": 0,          # 写入的消息总数
+        "max_batch_size": 0,   # 单次写入的最大消息数
+        "total_latency": 0.0,  # 写入总耗时(秒)
+        "max_latency": 0.0,    # 单次写入的最大耗时(秒)
+        "failures": 0,         # 写入失败次数
+    }
+    # 按聊天划分的锁，保证同一聊天的加载、追加、落盘和清空串行执行
+    _chat_locks = ChatLockRegistry()
     
     @staticmethod
     def init(config: AstrBotConfig):
@@ -27,9 +75,72 @@ class HistoryStorage:
         HistoryStorage._ensure_dir(HistoryStorage.base_storage_path)
         logger.info(f"消息存储路径初始化: {HistoryStorage.base_storage_path}")
         
-        # 配置jsonpickle
-        jsonpickle.set_encoder_options('json', ensure_ascii=False, indent=2)
-        jsonpickle.set_preferred_backend('json')
+        HistoryStorage._init_backend()
+    
+    @staticmethod
+    def _get_storage_config(key: str, default):
+        """读取history_storage配置项"""
+        if not HistoryStorage.config:
+            return default
+        return HistoryStorage.config.get("history_storage", {}).get(key, default)
+    
+    @staticmethod
+    def _init_backend() -> None:
+        """根据配置创建存储后端"""
+        if HistoryStorage._backend:
+            HistoryStorage._backend.close()
+        
+        backend_name = HistoryStorage._get_storage_config("backend", "json")
+        if backend_name == "sqlite":
+            db_path = os.path.join(HistoryStorage.base_storage_path, "history.db")
+            HistoryStorage._backend = SqliteHistoryBackend(db_path)
+            # 首次使用时需要导入日志文件中的旧数据
+            HistoryStorage._backend_ready = False
+        else:
+            HistoryStorage._backend = JsonlHistoryBackend(HistoryStorage.base_storage_path)
+            HistoryStorage._backend_ready = True
+        logger.info(f"历史记录存储后端: {backend_name}")
+    
+    @staticmethod
+    def _import_jsonl_to_sqlite() -> None:
+        """将日志文件中的历史记录一次性导入SQLite后端"""
+        source = JsonlHistoryBackend(HistoryStorage.base_storage_path)
+        HistoryStorage._backend.import_from_jsonl(source)
+    
+    @staticmethod
+    async def _get_backend() -> HistoryBackend:
+        """获取存储后端，首次使用SQLite后端时先在线程池中完成一次性导入"""
+        if HistoryStorage._backend is None:
+            if not HistoryStorage.base_storage_path:
+                HistoryStorage.base_storage_path = os.path.join(os.getcwd(), "data", "chat_history")
+                HistoryStorage._ensure_dir(HistoryStorage.base_storage_path)
+            HistoryStorage._init_backend()
+        
+        if not HistoryStorage._backend_ready:
+            if HistoryStorage._backend_ready_lock is None:
+                HistoryStorage._backend_ready_lock = asyncio.Lock()
+            async with HistoryStorage._backend_ready_lock:
+                if not HistoryStorage._backend_ready:
+                    try:
+                        await IOExecutor.run(HistoryStorage._import_jsonl_to_sqlite)
+                    except Exception as e:
+                        logger.error(f"导入旧版历史记录到SQLite失败: {e}")
+                        logger.debug(traceback.format_exc())
+                    HistoryStorage._backend_ready = True
+        return HistoryStorage._backend
+    
+    @staticmethod
+    def _get_chat_key(platform_name: str, is_private_chat: bool, chat_id: str) -> str:
+        """获取聊天的唯一标识，与LLMUtils保持一致"""
+        # 延迟导入，避免与llm_utils循环导入
+        from .llm_utils import LLMUtils
+        return LLMUtils.get_chat_key(platform_name, is_private_chat, chat_id)
+    
+    @staticmethod
+    def _get_chat_location(platform_name: str, is_private_chat: bool, chat_id: str) -> ChatLocation:
+        """获取聊天在存储后端中的位置"""
+        chat_type = "private" if is_private_chat else "group"
+        return (platform_name, chat_type, str(chat_id))
     
     @staticmethod
     def _ensure_dir(directory: str) -> None:
@@ -38,41 +149,213 @@ class HistoryStorage:
             os.makedirs(directory, exist_ok=True)
     
     @staticmethod
-    def _get_storage_path(platform_name: str, is_private_chat: bool, chat_id: str) -> str:
-        """获取存储路径"""
-        if not HistoryStorage.base_storage_path:
-            # 确保基础路径已初始化，未初始化则初始化一次
-            HistoryStorage.base_storage_path = os.path.join(os.getcwd(), "data", "chat_history")
-            HistoryStorage._ensure_dir(HistoryStorage.base_storage_path)
-            logger.info(f"消息存储路径初始化: {HistoryStorage.base_storage_path}")
+    async def _get_cached_history(chat_key: str, location: ChatLocation) -> deque:
+        """
+        获取常驻内存的历史记录，未命中时从存储后端加载
+        
+        调用方需持有该聊天的锁，并在释放锁之后调用_evict_if_needed
+        
+        Args:
+            chat_key: 聊天唯一标识
+            location: 聊天在存储后端中的位置
             
-        chat_type = "private" if is_private_chat else "group"
-        directory = os.path.join(HistoryStorage.base_storage_path, platform_name, chat_type)
+        Returns:
+            该聊天的历史记录环形缓冲区
+        """
+        history = HistoryStorage._cache.get(chat_key)
+        if history is not None:
+            HistoryStorage._cache.move_to_end(chat_key)
+            return history
         
-        HistoryStorage._ensure_dir(directory)
-        return os.path.join(directory, f"{chat_id}.json")
+        backend = await HistoryStorage._get_backend()
+        messages = await IOExecutor.run(backend.load, location)
+        history = deque(messages, maxlen=HistoryStorage.MAX_HISTORY)
+        HistoryStorage._cache[chat_key] = history
+        HistoryStorage._chat_locations[chat_key] = location
+        return history
     
     @staticmethod
-    def _sanitize_message(message: AstrBotMessage) -> AstrBotMessage:
+    async def _evict_if_needed() -> None:
         """
-        清理消息对象，移除可能导致序列化失败的属性
+        超过常驻聊天数量上限时，按LRU淘汰最久未访问的聊天
+        
+        不能在持有任何聊天锁时调用，否则两个聊天互相淘汰时会死锁
+        """
+        max_cached_chats = max(1, HistoryStorage._get_storage_config("max_cached_chats", 500))
+        for chat_key in list(HistoryStorage._cache):
+            if len(HistoryStorage._cache) <= max_cached_chats:
+                break
+            # 持有锁再淘汰，避免淘汰过程中该聊天被重新加载而丢失未写入的消息
+            async with HistoryStorage._chat_locks.lock(chat_key):
+                if chat_key not in HistoryStorage._cache or len(HistoryStorage._cache) <= max_cached_chats:
+                    continue
+                # 淘汰前先把未写入的消息落盘
+                await HistoryStorage._write_pending(chat_key)
+                if chat_key in HistoryStorage._pending:
+                    # 写入失败时保留在内存中，写入成功后再淘汰，否则未写入的消息会丢失
+                    logger.debug(f"聊天 {chat_key} 的消息写入失败，暂不淘汰")
+                    continue
+                HistoryStorage._cache.pop(chat_key, None)
+                HistoryStorage._chat_locations.pop(chat_key, None)
+                logger.debug(f"历史记录缓存已满，淘汰聊天: {chat_key}")
+    
+    @staticmethod
+    async def _flush_chat(chat_key: str) -> None:
+        """
+        将指定聊天未写入的消息写入存储后端
         
         Args:
-            message: AstrBot消息对象
-            
+            chat_key: 聊天唯一标识
+        """
+        async with HistoryStorage._chat_locks.lock(chat_key):
+            await HistoryStorage._write_pending(chat_key)
+    
+    @staticmethod
+    async def _write_pending(chat_key: str) -> None:
+        """
+        写入指定聊天未写入的消息，调用方需持有该聊天的锁
+        
+        Args:
+            chat_key: 聊天唯一标识
+        """
+        pending = HistoryStorage._pending.pop(chat_key, None)
+        HistoryStorage._dirty.discard(chat_key)
+        if not pending:
+            return
+        
+        location = HistoryStorage._chat_locations.get(chat_key)
+        if not location:
+            logger.warning(f"找不到聊天 {chat_key} 的存储位置，丢弃{len(pending)}条未保存消息")
+            return
+        
+        stats = HistoryStorage._flush_stats
+        start_time = time.perf_counter()
+        try:
+            backend = await HistoryStorage._get_backend()
+            await IOExecutor.run(backend.append, location, pending)
+        except Exception as e:
+            # 写入失败时保留消息，由后台维护任务重试
+            HistoryStorage._pending[chat_key] = pending + HistoryStorage._pending.get(chat_key, [])
+            HistoryStorage._dirty.add(chat_key)
+            stats["failures"] += 1
+            logger.error(f"写入历史记录失败 {chat_key}: {e}")
+            return
+        
+        latency = time.perf_counter() - start_time
+        stats["flushes"] += 1
+        stats["records"] += len(pending)
+        stats["max_batch_size"] = max(stats["max_batch_size"], len(pending))
+        stats["total_latency"] += latency
+        stats["max_latency"] = max(stats["max_latency"], latency)
+    
+    @staticmethod
+    def _schedule_flush(chat_key: str) -> None:
+        """
+        为聊天调度一次合并写入
+        
+        第一条待写入消息到达时启动写入任务，任务最多等待flush_max_delay_ms毫秒，
+        期间到达的消息会合并到同一次写入中；待写入消息达到flush_batch_size条时立即写入
+        
+        Args:
+            chat_key: 聊天唯一标识
+        """
+        waiter = HistoryStorage._flush_waiters.get(chat_key)
+        if waiter is None:
+            waiter = HistoryStorage._flush_waiters[chat_key] = asyncio.Event()
+            task = asyncio.get_running_loop().create_task(HistoryStorage._delayed_flush(chat_key, waiter))
+            HistoryStorage._flush_tasks.add(task)
+            task.add_done_callback(HistoryStorage._flush_tasks.discard)
+        
+        batch_size = HistoryStorage._get_storage_config("flush_batch_size", 20)
+        if len(HistoryStorage._pending.get(chat_key, [])) >= max(1, batch_size):
+            waiter.set()
+    
+    @staticmethod
+    async def _delayed_flush(chat_key: str, waiter: asyncio.Event) -> None:
+        """等待最大延迟或批量写满后，将聊天的待写入消息合并为一次写入"""
+        max_delay = HistoryStorage._get_storage_config("flush_max_delay_ms", 50) / 1000
+        try:
+            await asyncio.wait_for(waiter.wait(), timeout=max(0, max_delay))
+        except asyncio.TimeoutError:
+            pass
+        
+        # 从这里开始到达的消息会调度新一轮写入
+        if HistoryStorage._flush_waiters.get(chat_key) is waiter:
+            del HistoryStorage._flush_waiters[chat_key]
+        try:
+            await HistoryStorage._flush_chat(chat_key)
+        except Exception as e:
+            logger.error(f"合并写入历史记录时发生错误: {e}")
+    
+    @staticmethod
+    def get_flush_stats() -> Dict[str, float]:
+        """
+        获取合并写入的统计指标
+        
         Returns:
-            清理后的消息对象
+            统计指标字典，包含写入次数、平均/最大批量大小和平均/最大写入耗时(毫秒)
         """
-        # 创建消息的浅复制以避免修改原始对象
-        import copy
-        sanitized_message = copy.copy(message)
+        stats = HistoryStorage._flush_stats
+        flushes = stats["flushes"]
+        return {
+            "flushes": flushes,
+            "records": stats["records"],
+            "failures": stats["failures"],
+            "avg_batch_size": stats["records"] / flushes if flushes else 0,
+            "max_batch_size": stats["max_batch_size"],
+            "avg_latency_ms": stats["total_latency"] / flushes * 1000 if flushes else 0,
+            "max_latency_ms": stats["max_latency"] * 1000,
+            "pending_chats": len(HistoryStorage._dirty),
+        }
+    
+    @staticmethod
+    async def flush_all() -> None:
+        """将所有未写入的消息落盘"""
+        for chat_key in list(HistoryStorage._dirty):
+            await HistoryStorage._flush_chat(chat_key)
+    
+    @staticmethod
+    async def _flush_loop() -> None:
+        """后台任务：按配置的间隔重试写入失败的消息，并回收空闲的聊天锁"""
+        while True:
+            interval = HistoryStorage._get_storage_config("flush_interval", 5)
+            await asyncio.sleep(max(0.1, interval))
+            try:
+                await HistoryStorage.flush_all()
+                HistoryStorage._chat_locks.evict_idle()
+            except Exception as e:
+                logger.error(f"定期写入历史记录时发生错误: {e}")
+    
+    @staticmethod
+    def _ensure_flush_task() -> None:
+        """确保后台刷盘任务已启动"""
+        task = HistoryStorage._flush_task
+        if task is None or task.done():
+            HistoryStorage._flush_task = asyncio.get_running_loop().create_task(HistoryStorage._flush_loop())
+    
+    @staticmethod
+    async def shutdown() -> None:
+        """停止后台任务并将所有未写入的消息落盘，在插件卸载时调用"""
+        task = HistoryStorage._flush_task
+        HistoryStorage._flush_task = None
+        if task and not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
         
-        # 移除可能导致序列化问题的属性
-        for attr in ['_client', '_callback', '_handler', '_context', 'raw_message']:
-            if hasattr(sanitized_message, attr):
-                setattr(sanitized_message, attr, None)
+        # 让等待中的合并写入立即执行，并等待它们完成
+        for waiter in list(HistoryStorage._flush_waiters.values()):
+            waiter.set()
+        if HistoryStorage._flush_tasks:
+            await asyncio.gather(*list(HistoryStorage._flush_tasks), return_exceptions=True)
         
-        return sanitized_message
+        await HistoryStorage.flush_all()
+        if HistoryStorage._backend:
+            await IOExecutor.run(HistoryStorage._backend.close)
+            HistoryStorage._backend = None
+        logger.info("历史记录已全部写入磁盘")
     
     @staticmethod
     async def save_message(message: AstrBotMessage) -> bool:
@@ -98,43 +381,27 @@ class HistoryStorage:
             else:
                 chat_id = message.group_id
                 
-            # 获取存储路径
-            file_path = HistoryStorage._get_storage_path(platform_name, is_private_chat, chat_id)
-            
-            # 读取现有历史记录
-            history = HistoryStorage.get_history(platform_name, is_private_chat, chat_id)
-            if not history:
-                history = []
+            # 获取存储位置
+            location = HistoryStorage._get_chat_location(platform_name, is_private_chat, chat_id)
                 
             # 处理图片持久化存储
             await HistoryStorage._process_image_persistence(message)
 
-            # 清理消息对象，并添加到历史记录
-            sanitized_message = HistoryStorage._sanitize_message(message)
-            history.append(sanitized_message)
-
-            # 限制历史记录数量
-            if len(history) > 200:
-                history = history[-200:]
-
-            # 确保父目录存在
-            os.makedirs(os.path.dirname(file_path), exist_ok=True)
-
-            # 使用jsonpickle序列化对象
-            json_data = jsonpickle.encode(history, unpicklable=True)
-
-            # 写入文件
-            with open(file_path, "w", encoding="utf-8") as f:
-                f.write(json_data)
-
-            # 随机执行清理操作（避免每次都执行，减少性能影响）
-            import random
-            if random.random() < 0.05:  # 5% 的概率执行清理
-                try:
-                    HistoryStorage._cleanup_old_images()
-                except Exception as e:
-                    logger.error(f"执行图片清理时发生错误: {e}")
-
+            # 转换为精简的历史记录，加入内存中的历史记录
+            record = HistoryRecord.from_message(message)
+            # 提前生成格式化片段，格式化历史记录时只需拼接
+            MessageUtils.prerender_record(record)
+            chat_key = HistoryStorage._get_chat_key(platform_name, is_private_chat, chat_id)
+            async with HistoryStorage._chat_locks.lock(chat_key):
+                history = await HistoryStorage._get_cached_history(chat_key, location)
+                history.append(record)
+                
+                # 加入待写入队列，与短时间内的其他消息合并写入存储后端
+                HistoryStorage._pending.setdefault(chat_key, []).append(record)
+                HistoryStorage._dirty.add(chat_key)
+            HistoryStorage._schedule_flush(chat_key)
+            HistoryStorage._ensure_flush_task()
+            await HistoryStorage._evict_if_needed()
             return True
         except Exception as e:
             logger.error(f"保存消息历史记录失败: {e}")
@@ -188,6 +455,12 @@ class HistoryStorage:
         chat_type = "私聊" if event.is_private_chat() else "群聊"
         if success:
             logger.debug(f"已保存{chat_type}消息到历史记录")
+
+            # 开启入库时转述后，图片在后台提前转述，格式化历史记录时直接命中缓存
+            images = []
+            MessageUtils.collect_images(message_obj.message or [], images)
+            if images:
+                ImageCaptionUtils.enqueue_images(images, high_priority=not event.is_private_chat())
         else:
             logger.error(f"保存{chat_type}消息失败")
     
@@ -264,7 +537,7 @@ class HistoryStorage:
             return False
     
     @staticmethod
-    def get_history(platform_name: str, is_private_chat: bool, chat_id: str) -> List[AstrBotMessage]:
+    async def get_history(platform_name: str, is_private_chat: bool, chat_id: str, limit: Optional[int] = None) -> List[HistoryRecord]:
         """
         获取历史消息记录
         
@@ -272,20 +545,39 @@ class HistoryStorage:
             platform_name: 平台名称
             is_private_chat: 是否为私聊
             chat_id: 聊天ID
+            limit: 只获取最近的条数，为None时获取全部(最多MAX_HISTORY条)
             
         Returns:
             历史消息列表
         """
         try:
-            file_path = HistoryStorage._get_storage_path(platform_name, is_private_chat, chat_id)
-            
-            if not os.path.exists(file_path):
+            if limit is not None and limit <= 0:
                 return []
             
-            with open(file_path, "r", encoding="utf-8") as f:
-                # 使用jsonpickle反序列化JSON数据
-                history = jsonpickle.decode(f.read())
-                
+            chat_key = HistoryStorage._get_chat_key(platform_name, is_private_chat, chat_id)
+            history = HistoryStorage._cache.get(chat_key)
+            if history is not None:
+                # 命中内存缓存，不需要任何磁盘操作
+                HistoryStorage._cache.move_to_end(chat_key)
+                if limit is not None and limit < len(history):
+                    return list(itertools.islice(history, len(history) - limit, None))
+                return list(history)
+            
+            location = HistoryStorage._get_chat_location(platform_name, is_private_chat, chat_id)
+            if limit is not None and limit < HistoryStorage.MAX_HISTORY:
+                # 只需要最近几条时直接从存储后端读取这几条，不加载整个聊天
+                # 不在内存中的聊天没有未写入的消息，持有锁以等待可能正在进行的淘汰落盘
+                backend = await HistoryStorage._get_backend()
+                async with HistoryStorage._chat_locks.lock(chat_key):
+                    history = HistoryStorage._cache.get(chat_key)
+                    if history is not None:
+                        return list(history)[-limit:]
+                    return await IOExecutor.run(backend.load, location, limit)
+            
+            # 未命中时从存储后端加载并常驻
+            async with HistoryStorage._chat_locks.lock(chat_key):
+                history = list(await HistoryStorage._get_cached_history(chat_key, location))
+            await HistoryStorage._evict_if_needed()
             return history
         except Exception as e:
             logger.error(f"读取消息历史记录失败: {e}")
@@ -293,7 +585,7 @@ class HistoryStorage:
             return []
     
     @staticmethod
-    def clear_history(platform_name: str, is_private_chat: bool, chat_id: str) -> bool:
+    async def clear_history(platform_name: str, is_private_chat: bool, chat_id: str) -> bool:
         """
         清空历史消息记录
         
@@ -306,11 +598,18 @@ class HistoryStorage:
             是否清空成功
         """
         try:
-            file_path = HistoryStorage._get_storage_path(platform_name, is_private_chat, chat_id)
+            location = HistoryStorage._get_chat_location(platform_name, is_private_chat, chat_id)
+            chat_key = HistoryStorage._get_chat_key(platform_name, is_private_chat, chat_id)
+            backend = await HistoryStorage._get_backend()
             
-            if os.path.exists(file_path):
-                os.remove(file_path)
+            async with HistoryStorage._chat_locks.lock(chat_key):
+                # 丢弃内存中的记录和未写入的消息
+                HistoryStorage._cache.pop(chat_key, None)
+                HistoryStorage._chat_locations.pop(chat_key, None)
+                HistoryStorage._pending.pop(chat_key, None)
+                HistoryStorage._dirty.discard(chat_key)
                 
+                await IOExecutor.run(backend.clear, location)
             return True
         except Exception as e:
             logger.error(f"清空消息历史记录失败: {e}")
@@ -321,7 +620,7 @@ class HistoryStorage:
         """
         处理消息中的图片持久化存储
 
-        将图片保存为文件并在 file 字段中存储相对路径
+        将图片按内容哈希保存为文件并在 file 字段中存储绝对路径
 
         Args:
             message: AstrBot消息对象
@@ -339,17 +638,20 @@ class HistoryStorage:
 
             if not hasattr(message, 'message') or not message.message:
                 return
+            
+            # 没有图片的消息不需要访问图片目录
+            if not any(isinstance(component, Image) for component in message.message):
+                return
 
-            # 确保图片存储目录存在（使用 AstrBot 的数据路径，兼容 Docker）
-            from astrbot.core.utils.astrbot_path import get_astrbot_data_path
-            astrbot_data_path = get_astrbot_data_path()
-            images_dir = os.path.join(astrbot_data_path, "chat_history", "images")
-            HistoryStorage._ensure_dir(images_dir)
+            # 过期图片由ImageStorage的后台任务按最后引用时间清理
+            ImageStorage.ensure_sweeper()
 
             for component in message.message:
                 if isinstance(component, Image):
                     # 检查是否已经是持久化路径（file:/// 开头且指向 images 目录）
                     if component.file and component.file.startswith("file:///") and "/images/" in component.file:
+                        # 再次引用已持久化的图片，更新最后引用时间
+                        ImageStorage.touch(component.file[8:])
                         logger.debug("图片已经是持久化路径，跳过处理")
                         continue
 
@@ -359,28 +661,9 @@ class HistoryStorage:
                         temp_file_path = await component.convert_to_file_path()
                         logger.debug(f"获取的绝对路径:{temp_file_path}")
 
-                        if temp_file_path and os.path.exists(temp_file_path):
-                            # 生成唯一的文件名
-                            import uuid
-                            unique_id = uuid.uuid4().hex
-                            file_extension = ".jpg"  # 默认使用 jpg 扩展名
-
-                            # 尝试从原文件获取扩展名
-                            if "." in temp_file_path:
-                                original_ext = os.path.splitext(temp_file_path)[1].lower()
-                                if original_ext in ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp']:
-                                    file_extension = original_ext
-
-                            # 构建持久化文件路径
-                            persistent_filename = f"{unique_id}{file_extension}"
-                            persistent_file_path = os.path.join(images_dir, persistent_filename)
-
-                            # 复制文件到持久化目录
-                            import shutil
-                            shutil.copy2(temp_file_path, persistent_file_path)
-
-                            # 规范化路径（兼容 Docker 环境）
-                            persistent_file_path = os.path.abspath(persistent_file_path)
+                        if temp_file_path and await IOExecutor.run(os.path.exists, temp_file_path):
+                            # 按内容哈希保存，相同的图片只保存一份（规范化为绝对路径，兼容 Docker 环境）
+                            persistent_file_path = await ImageStorage.persist_file(temp_file_path)
 
                             # 存储绝对路径到 file 字段（使用 file:/// 前缀，兼容 AstrBot）
                             component.file = f"file:///{persistent_file_path}"
@@ -396,58 +679,3 @@ class HistoryStorage:
         except Exception as e:
             logger.error(f"处理图片持久化存储时发生错误: {e}")
             logger.debug(traceback.format_exc())
-
-    @staticmethod
-    def _cleanup_old_images() -> None:
-        """
-        清理超过配置天数的图片文件
-
-        防止图片文件无限增长
-        """
-        try:
-            # 检查是否启用图片持久化存储
-            if not HistoryStorage.config:
-                logger.debug("配置未初始化，跳过图片清理")
-                return
-
-            image_processing_config = HistoryStorage.config.get("image_processing", {})
-            if not image_processing_config.get("enable_image_persistence", True):
-                logger.debug("图片持久化存储已禁用，跳过清理")
-                return
-
-            # 获取配置的保留天数
-            retention_days = image_processing_config.get("image_retention_days", 7)
-            if retention_days < 1 or retention_days > 365:
-                logger.warning(f"图片保留天数配置无效: {retention_days}，使用默认值7天")
-                retention_days = 7
-
-            # 使用 AstrBot 的数据路径（兼容 Docker）
-            from astrbot.core.utils.astrbot_path import get_astrbot_data_path
-            astrbot_data_path = get_astrbot_data_path()
-            images_dir = os.path.join(astrbot_data_path, "chat_history", "images")
-            if not os.path.exists(images_dir):
-                return
-
-            current_time = time.time()
-            cleanup_threshold = retention_days * 24 * 3600  # 配置的天数转换为秒
-            cleaned_count = 0
-
-            for filename in os.listdir(images_dir):
-                file_path = os.path.join(images_dir, filename)
-                if os.path.isfile(file_path):
-                    # 检查文件创建时间
-                    file_ctime = os.path.getctime(file_path)
-                    if current_time - file_ctime > cleanup_threshold:
-                        try:
-                            os.remove(file_path)
-                            cleaned_count += 1
-                            logger.debug(f"清理过期图片文件: {filename}")
-                        except Exception as e:
-                            logger.error(f"删除过期图片文件失败 {filename}: {e}")
-
-            if cleaned_count > 0:
-                logger.info(f"图片清理完成，清理了 {cleaned_count} 个超过 {retention_days} 天的图片文件")
-
-        except Exception as e:
-            logger.error(f"清理图片文件时发生错误: {e}")
-
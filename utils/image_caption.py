@@ -1,25 +1,259 @@
 from astrbot.api.all import *
-from typing import Optional
+from typing import Dict, List, Optional
 import asyncio
+import hashlib
+import itertools
+import os
+import re
+import time
+from .caption_cache import CaptionCache
+from .io_executor import IOExecutor
 
 class ImageCaptionUtils:
     """
     图片转述工具类
     
     用于调用大语言模型将图片转述为文本描述
+    图片描述按图片内容哈希缓存，缓存有容量和有效期限制，并持久化到磁盘
     """
     
     # 保存context和config对象的静态变量
     context = None
     config = None
-    # 图片描述缓存
-    caption_cache = {}
+    # 图片描述缓存，首次使用时创建
+    caption_cache: Optional[CaptionCache] = None
+    _cache_lock: Optional[asyncio.Lock] = None
+    _cache_flush_task: Optional[asyncio.Task] = None
+    # 缓存修改在内存中积累多久后写入磁盘（秒）
+    CACHE_FLUSH_DELAY = 2
+    # 进行中的转述请求，格式: {cache_key: Task}，同一张图片的并发请求共享同一个Task
+    _inflight: Dict[str, asyncio.Task] = {}
+    # 转述失败的图片，格式: {cache_key: 可以重试的时间}，冷却期内不再调用大模型
+    _failures: Dict[str, float] = {}
+    # 转述失败或超时后的冷却时间（秒）
+    FAILURE_TTL = 60
+    # 失败冷却表的最大条目数
+    MAX_FAILURE_ENTRIES = 1000
+    # 入库时转述的任务队列，格式: (优先级, 序号, 图片)，优先级数值越小越先处理
+    _ingest_queue: Optional[asyncio.PriorityQueue] = None
+    _ingest_workers: List[asyncio.Task] = []
+    _ingest_seq = itertools.count()
+    _ingest_stats: Dict[str, int] = {
+        "queued": 0,     # 加入队列的图片数
+        "dropped": 0,    # 队列已满被丢弃的图片数
+        "captioned": 0,  # 已完成转述的图片数
+    }
+    # 合并转述多张图片时使用的提示词，要求按编号逐行输出
+    BATCH_PROMPT_TEMPLATE = (
+        "{prompt}\n"
+        "下面共有{count}张图片，请按顺序分别描述每一张。"
+        "严格按照“编号. 描述”的格式输出{count}行，每张图片一行，不要输出其他内容，例如:\n"
+        "1. 第一张图片的描述\n"
+        "2. 第二张图片的描述"
+    )
+    # 合并转述回复中的一行，如“1. 描述”、“[2] 描述”、“3、描述”
+    _BATCH_LINE_PATTERN = re.compile(r"^\s*(?:第)?\[?(\d+)\]?\s*(?:张(?:图片)?)?\s*[\.、:：)）\]]?\s*(\S.*?)\s*$")
+    # 持久化图片以内容的SHA-256命名，文件名即可作为缓存键
+    _HASH_FILENAME_PATTERN = re.compile(r"^[0-9a-f]{64}$")
     
     @staticmethod
     def init(context: Context, config: AstrBotConfig):
         """初始化图片转述工具类，保存context和config引用"""
         ImageCaptionUtils.context = context
         ImageCaptionUtils.config = config
+
+    @staticmethod
+    async def _get_cache() -> Optional[CaptionCache]:
+        """获取图片描述缓存，首次调用时打开数据库并加载"""
+        if ImageCaptionUtils.caption_cache is not None:
+            return ImageCaptionUtils.caption_cache
+
+        if ImageCaptionUtils._cache_lock is None:
+            ImageCaptionUtils._cache_lock = asyncio.Lock()
+        async with ImageCaptionUtils._cache_lock:
+            if ImageCaptionUtils.caption_cache is None:
+                image_processing_config = (ImageCaptionUtils.config or {}).get("image_processing", {})
+                max_entries = int(image_processing_config.get("caption_cache_size", 2000))
+                ttl_days = int(image_processing_config.get("caption_cache_ttl_days", 30))
+
+                from astrbot.core.utils.astrbot_path import get_astrbot_data_path
+                cache_dir = os.path.join(get_astrbot_data_path(), "chat_history")
+                await IOExecutor.run(lambda: os.makedirs(cache_dir, exist_ok=True))
+                db_path = os.path.join(cache_dir, "image_captions.db")
+
+                cache = await IOExecutor.run(CaptionCache, db_path, max_entries, ttl_days * 86400)
+                loaded = await IOExecutor.run(cache.load)
+                logger.debug(f"已加载图片描述缓存，共{loaded}条")
+                ImageCaptionUtils.caption_cache = cache
+        return ImageCaptionUtils.caption_cache
+
+    @staticmethod
+    def _hash_file(file_path: str) -> str:
+        """计算文件内容的SHA-256"""
+        digest = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @staticmethod
+    async def get_image_key(image: str) -> str:
+        """
+        获取图片的缓存键
+
+        本地文件使用文件内容的SHA-256，持久化图片直接使用文件名中的哈希；
+        网络链接和base64编码无法预先获取文件内容，使用字符串本身的哈希
+
+        Args:
+            image: 图片的本地路径、base64编码或URL
+
+        Returns:
+            缓存键
+        """
+        if not image.startswith(("http://", "https://", "base64://")):
+            stem = os.path.splitext(os.path.basename(image))[0]
+            if ImageCaptionUtils._HASH_FILENAME_PATTERN.match(stem):
+                return stem
+            try:
+                return await IOExecutor.run(ImageCaptionUtils._hash_file, image)
+            except OSError:
+                pass
+        return hashlib.sha256(image.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    async def _flush_cache_later() -> None:
+        """延迟一段时间后将缓存修改批量写入磁盘"""
+        try:
+            await asyncio.sleep(ImageCaptionUtils.CACHE_FLUSH_DELAY)
+        finally:
+            ImageCaptionUtils._cache_flush_task = None
+        await ImageCaptionUtils.flush_cache()
+
+    @staticmethod
+    async def flush_cache() -> None:
+        """将图片描述缓存的修改写入磁盘"""
+        cache = ImageCaptionUtils.caption_cache
+        if cache is None or not cache.has_pending():
+            return
+        try:
+            await IOExecutor.run(cache.write, *cache.drain())
+        except Exception as e:
+            logger.error(f"保存图片描述缓存失败: {e}")
+
+    @staticmethod
+    def _schedule_cache_flush() -> None:
+        """安排一次延迟写入，同一时间只有一个写入任务"""
+        if ImageCaptionUtils._cache_flush_task is None:
+            ImageCaptionUtils._cache_flush_task = asyncio.get_running_loop().create_task(
+                ImageCaptionUtils._flush_cache_later()
+            )
+
+    @staticmethod
+    def get_cache_stats() -> Dict[str, int]:
+        """
+        获取图片描述缓存的统计指标
+
+        Returns:
+            统计指标字典，缓存尚未创建时为空
+        """
+        cache = ImageCaptionUtils.caption_cache
+        return cache.get_stats() if cache else {}
+
+    @staticmethod
+    def enqueue_images(images: List[str], high_priority: bool = False) -> int:
+        """
+        将入库消息中的图片加入后台转述队列，提前生成图片描述
+
+        需要开启 image_processing.eager_caption，队列已满时直接丢弃，
+        未转述的图片仍会在格式化历史记录时按需转述
+
+        Args:
+            images: 图片的本地路径、base64编码或URL列表
+            high_priority: 是否优先处理，用于已启用的群聊
+
+        Returns:
+            加入队列的图片数量
+        """
+        image_processing_config = (ImageCaptionUtils.config or {}).get("image_processing", {})
+        if not images or not image_processing_config.get("use_image_caption", False):
+            return 0
+        if not image_processing_config.get("eager_caption", False):
+            return 0
+
+        queue = ImageCaptionUtils._ensure_ingest_workers(image_processing_config)
+        priority = 0 if high_priority else 1
+        queued = 0
+        for image in dict.fromkeys(images):
+            try:
+                queue.put_nowait((priority, next(ImageCaptionUtils._ingest_seq), image))
+                queued += 1
+            except asyncio.QueueFull:
+                ImageCaptionUtils._ingest_stats["dropped"] += 1
+                logger.debug(f"图片转述队列已满，丢弃: {image[:50]}...")
+        ImageCaptionUtils._ingest_stats["queued"] += queued
+        return queued
+
+    @staticmethod
+    def _ensure_ingest_workers(image_processing_config: Dict) -> asyncio.PriorityQueue:
+        """创建转述队列并启动后台转述任务"""
+        if ImageCaptionUtils._ingest_queue is None:
+            queue_size = max(1, int(image_processing_config.get("eager_caption_queue_size", 100)))
+            ImageCaptionUtils._ingest_queue = asyncio.PriorityQueue(maxsize=queue_size)
+
+        workers = max(1, int(image_processing_config.get("eager_caption_workers", 2)))
+        ImageCaptionUtils._ingest_workers = [t for t in ImageCaptionUtils._ingest_workers if not t.done()]
+        loop = asyncio.get_running_loop()
+        while len(ImageCaptionUtils._ingest_workers) < workers:
+            ImageCaptionUtils._ingest_workers.append(loop.create_task(ImageCaptionUtils._ingest_worker()))
+        return ImageCaptionUtils._ingest_queue
+
+    @staticmethod
+    async def _ingest_worker() -> None:
+        """后台任务：依次转述队列中的图片，结果写入图片描述缓存"""
+        queue = ImageCaptionUtils._ingest_queue
+        while True:
+            _, _, image = await queue.get()
+            try:
+                if await ImageCaptionUtils.generate_image_caption(image):
+                    ImageCaptionUtils._ingest_stats["captioned"] += 1
+            except Exception as e:
+                logger.error(f"后台图片转述失败: {e}")
+            finally:
+                queue.task_done()
+
+    @staticmethod
+    def get_ingest_stats() -> Dict[str, int]:
+        """
+        获取入库时转述队列的统计指标
+
+        Returns:
+            统计指标字典，包含排队中、已丢弃和已完成的图片数
+        """
+        stats = dict(ImageCaptionUtils._ingest_stats)
+        queue = ImageCaptionUtils._ingest_queue
+        stats["pending"] = queue.qsize() if queue else 0
+        return stats
+
+    @staticmethod
+    async def shutdown() -> None:
+        """插件卸载时写入缓存修改并关闭数据库"""
+        for worker in ImageCaptionUtils._ingest_workers:
+            worker.cancel()
+        ImageCaptionUtils._ingest_workers = []
+        ImageCaptionUtils._ingest_queue = None
+        for inflight_task in list(ImageCaptionUtils._inflight.values()):
+            inflight_task.cancel()
+        ImageCaptionUtils._inflight.clear()
+        task = ImageCaptionUtils._cache_flush_task
+        if task:
+            task.cancel()
+            ImageCaptionUtils._cache_flush_task = None
+        cache = ImageCaptionUtils.caption_cache
+        if cache is None:
+            return
+        await ImageCaptionUtils.flush_cache()
+        ImageCaptionUtils.caption_cache = None
+        await IOExecutor.run(cache.close)
     
     @staticmethod
     async def generate_image_caption(
@@ -36,19 +270,49 @@ class ImageCaptionUtils:
         Returns:
             生成的图片描述文本，如果失败则返回None
         """
-        # 检查缓存
-        if image in ImageCaptionUtils.caption_cache:
-            logger.debug(f"命中图片描述缓存: {image[:50]}...")
-            return ImageCaptionUtils.caption_cache[image]
-            
         # 获取配置
         config = ImageCaptionUtils.config
-        context = ImageCaptionUtils.context
         # 检查是否已启用图片转述
         image_processing_config = config.get("image_processing", {})
         if not image_processing_config.get("use_image_caption", False):
             return None
 
+        # 检查缓存
+        cache = await ImageCaptionUtils._get_cache()
+        cache_key = await ImageCaptionUtils.get_image_key(image)
+        cached_caption = cache.get(cache_key)
+        if cached_caption is not None:
+            logger.debug(f"命中图片描述缓存: {image[:50]}...")
+            ImageCaptionUtils._schedule_cache_flush()
+            return cached_caption
+
+        # 同一张图片已有进行中的转述请求时，等待该请求的结果，不重复调用大模型
+        task = ImageCaptionUtils._inflight.get(cache_key)
+        if task is not None:
+            logger.debug(f"等待进行中的图片转述: {image[:50]}...")
+            return await asyncio.shield(task)
+
+        # 最近转述失败的图片在短时间内不再重试
+        if ImageCaptionUtils._is_recently_failed(cache_key):
+            logger.debug(f"图片最近转述失败，暂不重试: {image[:50]}...")
+            return None
+
+        provider = ImageCaptionUtils._get_provider(image_processing_config)
+        if not provider:
+             return None
+
+        prompt = image_processing_config.get("image_caption_prompt", "请直接简短描述这张图片")
+        task = asyncio.get_running_loop().create_task(
+            ImageCaptionUtils._request_caption(provider, prompt, image, cache_key, timeout)
+        )
+        ImageCaptionUtils._register_inflight(cache_key, task)
+        # 调用方被取消时不影响其他等待同一张图片的调用方
+        return await asyncio.shield(task)
+
+    @staticmethod
+    def _get_provider(image_processing_config: Dict):
+        """获取图像转述提供商，找不到时返回None"""
+        context = ImageCaptionUtils.context
         provider_id = image_processing_config.get("image_caption_provider_id", "")
         # 获取提供商
         if provider_id == "":
@@ -58,13 +322,250 @@ class ImageCaptionUtils:
         
         if not provider:
              logger.warning(f"无法找到提供商: {provider_id if provider_id else '默认'}")
-             return None
+        return provider
+
+    @staticmethod
+    def _register_inflight(cache_key: str, task: asyncio.Task) -> None:
+        """登记进行中的转述请求，请求结束后自动移除"""
+        ImageCaptionUtils._inflight[cache_key] = task
+        task.add_done_callback(lambda t: ImageCaptionUtils._inflight.pop(cache_key, None)
+                               if ImageCaptionUtils._inflight.get(cache_key) is t else None)
+
+    @staticmethod
+    async def generate_image_captions(images: List[str]) -> Dict[str, Optional[str]]:
+        """
+        并发地为多张图片生成文字描述
+
+        并发数量和总时限由 image_processing.caption_concurrency 和
+        image_processing.caption_deadline 控制，超过总时限仍未完成的图片不会出现在结果中，
+        其转述请求会在后台继续进行，完成后写入缓存供下次使用
+
+        image_processing.caption_batch_size 大于1时，每次请求最多转述这么多张图片
+
+        Args:
+            images: 图片的本地路径、base64编码或URL列表，可以重复
+
+        Returns:
+            已完成的图片描述，格式: {image: caption}，转述失败时caption为None
+        """
+        unique_images = list(dict.fromkeys(image for image in images if image))
+        if not unique_images:
+            return {}
+
+        image_processing_config = (ImageCaptionUtils.config or {}).get("image_processing", {})
+        concurrency = max(1, int(image_processing_config.get("caption_concurrency", 4)))
+        deadline = float(image_processing_config.get("caption_deadline", 20))
+        batch_size = max(1, int(image_processing_config.get("caption_batch_size", 1)))
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def caption_group(group: List[str]) -> Dict[str, Optional[str]]:
+            async with semaphore:
+                if len(group) > 1:
+                    return await ImageCaptionUtils._generate_batch_captions(group, timeout=deadline)
+                return {group[0]: await ImageCaptionUtils.generate_image_caption(group[0], timeout=deadline)}
+
+        groups = [unique_images[i:i + batch_size] for i in range(0, len(unique_images), batch_size)]
+        tasks = {asyncio.ensure_future(caption_group(group)): group for group in groups}
+        done, pending = await asyncio.wait(tasks.keys(), timeout=deadline)
+        for task in pending:
+            task.cancel()
+        if pending:
+            missing = sum(len(tasks[task]) for task in pending)
+            logger.warning(f"图片转述超过了{deadline}秒，{missing}张图片将不带描述")
+
+        captions = {}
+        for task in done:
+            try:
+                captions.update(task.result())
+            except Exception as e:
+                logger.error(f"图片转述失败: {e}")
+                captions.update(dict.fromkeys(tasks[task]))
+        return captions
+
+    @staticmethod
+    async def _generate_batch_captions(images: List[str], timeout: float) -> Dict[str, Optional[str]]:
+        """
+        在一次请求中为一组图片生成文字描述
+
+        已缓存、正在转述或最近失败的图片按单张处理，其余图片合并为一次请求，
+        合并请求的每张图片同样登记为进行中的请求，其他调用方可以共享结果
+
+        Args:
+            images: 图片的本地路径、base64编码或URL列表，不重复
+            timeout: 超时时间（秒）
+
+        Returns:
+            图片描述，格式: {image: caption}，转述失败时caption为None
+        """
+        image_processing_config = ImageCaptionUtils.config.get("image_processing", {})
+        if not image_processing_config.get("use_image_caption", False):
+            return dict.fromkeys(images)
+
+        cache = await ImageCaptionUtils._get_cache()
+        captions: Dict[str, Optional[str]] = {}
+        batch: Dict[str, str] = {}
+        single: List[str] = []
+        for image in images:
+            cache_key = await ImageCaptionUtils.get_image_key(image)
+            cached_caption = cache.get(cache_key)
+            if cached_caption is not None:
+                captions[image] = cached_caption
+            elif (cache_key in batch or cache_key in ImageCaptionUtils._inflight
+                    or ImageCaptionUtils._is_recently_failed(cache_key)):
+                single.append(image)
+            else:
+                batch[cache_key] = image
+        if captions:
+            ImageCaptionUtils._schedule_cache_flush()
+
+        provider = ImageCaptionUtils._get_provider(image_processing_config) if len(batch) > 1 else None
+        if provider is None:
+            single.extend(batch.values())
+            batch = {}
+
+        waiters = {}
+        if batch:
+            prompt = image_processing_config.get("image_caption_prompt", "请直接简短描述这张图片")
+            loop = asyncio.get_running_loop()
+            batch_task = loop.create_task(
+                ImageCaptionUtils._request_batch_captions(provider, prompt, batch, timeout)
+            )
+
+            async def pick(cache_key: str) -> Optional[str]:
+                return (await asyncio.shield(batch_task)).get(cache_key)
+
+            for cache_key, image in batch.items():
+                waiters[image] = loop.create_task(pick(cache_key))
+                ImageCaptionUtils._register_inflight(cache_key, waiters[image])
+        for image in single:
+            waiters[image] = asyncio.ensure_future(ImageCaptionUtils.generate_image_caption(image, timeout))
+
+        # 调用方被取消时请求在后台继续进行，完成后写入缓存
+        results = await asyncio.shield(asyncio.gather(*waiters.values()))
+        captions.update(zip(waiters.keys(), results))
+        return captions
+
+    @staticmethod
+    def _parse_batch_captions(text: str, count: int) -> Optional[List[str]]:
+        """
+        解析合并请求的回复，回复应为每行一条的编号列表
+
+        Args:
+            text: 大模型的回复
+            count: 图片数量
+
+        Returns:
+            按图片顺序排列的描述列表，编号缺失或重复时返回None
+        """
+        captions = {}
+        for line in (text or "").splitlines():
+            match = ImageCaptionUtils._BATCH_LINE_PATTERN.match(line)
+            if not match:
+                continue
+            index = int(match.group(1))
+            if index in captions or not 1 <= index <= count:
+                return None
+            captions[index] = match.group(2)
+        if len(captions) != count:
+            return None
+        return [captions[i] for i in range(1, count + 1)]
+
+    @staticmethod
+    async def _request_batch_captions(provider, prompt: str, batch: Dict[str, str], timeout: float) -> Dict[str, Optional[str]]:
+        """
+        调用大模型一次转述多张图片并分别写入缓存，回复无法解析时改为逐张转述
+
+        Args:
+            provider: 图像转述提供商
+            prompt: 图像转述提示词
+            batch: 需要转述的图片，格式: {cache_key: image}
+            timeout: 超时时间（秒）
 
+        Returns:
+            图片描述，格式: {cache_key: caption}，转述失败时caption为None
+        """
+        count = len(batch)
+        batch_prompt = ImageCaptionUtils.BATCH_PROMPT_TEMPLATE.format(prompt=prompt, count=count)
+        try:
+            llm_response = await asyncio.wait_for(
+                provider.text_chat(
+                    prompt=batch_prompt,
+                    contexts=[],
+                    image_urls=list(batch.values()),
+                    func_tool=None,
+                    system_prompt=""
+                ),
+                timeout=timeout
+            )
+            captions = ImageCaptionUtils._parse_batch_captions(llm_response.completion_text, count)
+        except asyncio.TimeoutError:
+            logger.warning(f"合并图片转述超时，超过了{timeout}秒")
+            for cache_key in batch:
+                ImageCaptionUtils._record_failure(cache_key)
+            return {}
+        except Exception as e:
+            logger.warning(f"合并图片转述失败，改为逐张转述: {e}")
+            captions = None
+
+        if captions is None:
+            logger.debug(f"无法解析合并图片转述的回复，改为逐张转述{count}张图片")
+            results = await asyncio.gather(*[
+                ImageCaptionUtils._request_caption(provider, prompt, image, cache_key, timeout)
+                for cache_key, image in batch.items()
+            ])
+            return dict(zip(batch.keys(), results))
+
+        cache = ImageCaptionUtils.caption_cache
+        for cache_key, caption in zip(batch.keys(), captions):
+            if cache is not None:
+                cache.put(cache_key, caption)
+        ImageCaptionUtils._schedule_cache_flush()
+        logger.debug(f"合并转述了{count}张图片")
+        return dict(zip(batch.keys(), captions))
+
+    @staticmethod
+    def _is_recently_failed(cache_key: str) -> bool:
+        """检查图片是否在失败冷却期内"""
+        retry_at = ImageCaptionUtils._failures.get(cache_key)
+        if retry_at is None:
+            return False
+        if time.monotonic() >= retry_at:
+            del ImageCaptionUtils._failures[cache_key]
+            return False
+        return True
+
+    @staticmethod
+    def _record_failure(cache_key: str) -> None:
+        """记录一次转述失败，冷却期内的请求直接返回None"""
+        now = time.monotonic()
+        failures = ImageCaptionUtils._failures
+        if len(failures) >= ImageCaptionUtils.MAX_FAILURE_ENTRIES:
+            for key in [k for k, retry_at in failures.items() if retry_at <= now]:
+                del failures[key]
+            if len(failures) >= ImageCaptionUtils.MAX_FAILURE_ENTRIES:
+                failures.pop(next(iter(failures)))
+        failures[cache_key] = now + ImageCaptionUtils.FAILURE_TTL
+
+    @staticmethod
+    async def _request_caption(provider, prompt: str, image: str, cache_key: str, timeout: int) -> Optional[str]:
+        """
+        调用大模型转述图片并写入缓存，失败或超时时记录到失败冷却表
+
+        Args:
+            provider: 图像转述提供商
+            prompt: 图像转述提示词
+            image: 图片的本地路径、base64编码或URL
+            cache_key: 图片的缓存键
+            timeout: 超时时间（秒）
+
+        Returns:
+            生成的图片描述文本，如果失败则返回None
+        """
         try:
             # 带超时控制的调用大模型进行图片转述
             async def call_llm():
                 return await provider.text_chat(
-                    prompt=image_processing_config.get("image_caption_prompt", "请直接简短描述这张图片"),
+                    prompt=prompt,
                     contexts=[], 
                     image_urls=[image], # 图片链接，支持路径和网络链接
                     func_tool=None, # 当前用户启用的函数调用工具。如果不需要，可以不传
@@ -76,14 +577,20 @@ class ImageCaptionUtils:
             caption = llm_response.completion_text
             
             # 缓存结果
-            if caption:
-                 ImageCaptionUtils.caption_cache[image] = caption
+            cache = ImageCaptionUtils.caption_cache
+            if caption and cache is not None:
+                 cache.put(cache_key, caption)
+                 ImageCaptionUtils._schedule_cache_flush()
                  logger.debug(f"缓存图片描述: {image[:50]}... -> {caption}")
+            elif not caption:
+                 ImageCaptionUtils._record_failure(cache_key)
                  
             return caption
         except asyncio.TimeoutError:
             logger.warning(f"图片转述超时，超过了{timeout}秒")
+            ImageCaptionUtils._record_failure(cache_key)
             return None
         except Exception as e:
             logger.error(f"图片转述失败: {e}")
+            ImageCaptionUtils._record_failure(cache_key)
             return None
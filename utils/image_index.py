@@ -0,0 +1,66 @@
+from typing import Dict, Iterable
+import sqlite3
+import threading
+
+class ImageIndex:
+    """
+    持久化图片的过期索引
+
+    每个图片文件一行(文件名, 最后引用时间)，只写入发生变化的行，
+    图片数量很多时也不需要重写整个索引
+
+    所有方法都是阻塞的，由调用方放到IO线程池中执行
+    """
+
+    def __init__(self, db_path: str):
+        """
+        Args:
+            db_path: 数据库文件路径
+        """
+        self.db_path = db_path
+        # 连接会在IO线程池的多个线程中使用，由锁串行化访问
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS images ("
+                "filename TEXT PRIMARY KEY, "
+                "last_used REAL NOT NULL)"
+            )
+            self._conn.commit()
+
+    def load(self) -> Dict[str, float]:
+        """
+        读取整个索引
+
+        Returns:
+            过期索引，格式: {filename: 最后引用时间}
+        """
+        with self._lock:
+            return dict(self._conn.execute("SELECT filename, last_used FROM images").fetchall())
+
+    def write(self, touches: Dict[str, float], deletes: Iterable[str]) -> None:
+        """
+        在一个事务中写入一批修改
+
+        Args:
+            touches: 新增或更新了最后引用时间的文件，格式: {filename: 最后引用时间}
+            deletes: 已删除的文件名
+        """
+        deletes = list(deletes)
+        with self._lock:
+            with self._conn:
+                if deletes:
+                    self._conn.executemany("DELETE FROM images WHERE filename = ?", [(name,) for name in deletes])
+                if touches:
+                    self._conn.executemany(
+                        "INSERT OR REPLACE INTO images (filename, last_used) VALUES (?, ?)",
+                        touches.items()
+                    )
+
+    def close(self) -> None:
+        """关闭数据库连接"""
+        with self._lock:
+            self._conn.close()
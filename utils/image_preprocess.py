@@ -0,0 +1,94 @@
+from astrbot.api.all import *
+import os
+import threading
+
+try:
+    from PIL import Image as PILImage, ImageOps
+except ImportError:  # Pillow未安装时不进行预处理，直接保存原图
+    PILImage = None
+    ImageOps = None
+
+class ImagePreprocessor:
+    """
+    图片预处理工具类
+
+    将图片缩放到限定尺寸并重新压缩为JPEG/WebP，用于持久化存储和图片转述，
+    减少磁盘占用、上传流量和转述延迟。完全在本地使用Pillow处理，不需要联网
+    """
+
+    # 支持的输出格式，格式: {配置值: (Pillow格式名, 扩展名)}
+    FORMATS = {
+        "jpeg": ("JPEG", ".jpg"),
+        "webp": ("WEBP", ".webp"),
+    }
+
+    @staticmethod
+    def is_available() -> bool:
+        """Pillow是否可用"""
+        return PILImage is not None
+
+    @staticmethod
+    def get_extension(output_format: str) -> str:
+        """获取输出格式对应的扩展名，未知格式按jpeg处理"""
+        return ImagePreprocessor.FORMATS.get(output_format, ImagePreprocessor.FORMATS["jpeg"])[1]
+
+    @staticmethod
+    def create_derivative(
+            source_path: str,
+            target_path: str,
+            max_dimension: int = 1280,
+            quality: int = 80,
+            output_format: str = "jpeg"
+        ) -> bool:
+        """
+        生成缩放并重新压缩后的图片，在IO线程池中调用
+
+        动图、无法识别的文件以及压缩后没有变小的图片不生成，由调用方保存原图
+
+        Args:
+            source_path: 源文件路径
+            target_path: 输出文件路径
+            max_dimension: 长边的最大像素数
+            quality: 压缩质量(1-100)
+            output_format: 输出格式，jpeg或webp
+
+        Returns:
+            是否生成了输出文件
+        """
+        if PILImage is None:
+            return False
+
+        pil_format = ImagePreprocessor.FORMATS.get(output_format, ImagePreprocessor.FORMATS["jpeg"])[0]
+        temp_path = f"{target_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with PILImage.open(source_path) as img:
+                # 动图重新编码会丢失动画，保留原图
+                if getattr(img, "is_animated", False):
+                    return False
+
+                # 重新编码会丢失EXIF方向标记，先按标记旋转，避免手机拍摄的照片方向错误
+                img = ImageOps.exif_transpose(img)
+                img.thumbnail((max_dimension, max_dimension))
+                if pil_format == "JPEG" and img.mode not in ("RGB", "L"):
+                    # JPEG不支持透明通道，透明部分填充为白色
+                    img = img.convert("RGBA")
+                    background = PILImage.new("RGB", img.size, (255, 255, 255))
+                    background.paste(img, mask=img.getchannel("A"))
+                    img = background
+                elif pil_format == "WEBP" and img.mode not in ("RGB", "RGBA", "L"):
+                    img = img.convert("RGBA")
+
+                img.save(temp_path, pil_format, quality=max(1, min(int(quality), 100)), optimize=True)
+        except Exception as e:
+            logger.debug(f"图片预处理失败，将保存原图: {e}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return False
+
+        # 压缩后没有变小时保留原图
+        if os.path.getsize(temp_path) >= os.path.getsize(source_path):
+            os.remove(temp_path)
+            return False
+
+        os.replace(temp_path, target_path)
+        return True
@@ -0,0 +1,512 @@
+import os
+from typing import Dict, List, Optional, Set, Tuple
+from astrbot.api.all import *
+import asyncio
+import hashlib
+import heapq
+import json
+import shutil
+import threading
+import time
+import traceback
+from .io_executor import IOExecutor
+from .image_index import ImageIndex
+from .image_preprocess import ImagePreprocessor
+
+class ImageStorage:
+    """
+    持久化图片存储工具类
+
+    图片按内容的SHA-256命名，相同的图片(如反复转发的表情包)只保存一份，
+    已存在时跳过复制，只更新最后引用时间
+
+    维护持久化图片的过期索引(文件名 -> 最后引用时间)，并增量保存到图片目录下的SQLite数据库中
+    后台任务按固定间隔从索引中取出最久未被引用的图片，每次最多删除一批，
+    不再遍历整个图片目录，也不会在消息处理流程中执行清理
+    """
+
+    # 保存配置对象的静态变量
+    config = None
+    # 索引数据库文件名，以.开头，不会被当作图片处理
+    INDEX_FILENAME = ".index.db"
+    # 旧版的JSON清单文件，首次加载时导入索引数据库后删除
+    MANIFEST_FILENAME = ".manifest.json"
+
+    # 图片存储目录，首次使用时解析并创建
+    _images_dir: Optional[str] = None
+    # 支持的图片扩展名
+    IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp']
+
+    # 过期索引，格式: {filename: 最后引用时间}
+    _manifest: Dict[str, float] = {}
+    # 已从索引中取出、等待在IO线程池中删除的文件
+    # 删除前再次引用的文件会从中移除，不再删除，读写时需持有_file_lock
+    _pending_deletes: Set[str] = set()
+    # 正在被_store_file复用或写入、尚未登记到索引的文件，清理任务不会删除
+    # 读写时需持有_file_lock，登记后清除
+    _reused: Set[str] = set()
+    _file_lock = threading.Lock()
+    # 按最后引用时间排序的小顶堆，格式: [(最后引用时间, filename), ...]
+    # 引用时间更新后旧的条目不会立即删除，出堆时与_manifest比对后跳过
+    _heap: List[Tuple[float, str]] = []
+    # 索引数据库，首次清理时加载
+    _index: Optional[ImageIndex] = None
+    # 尚未写入索引数据库的修改
+    _pending_touches: Dict[str, float] = {}
+    _pending_removals: Set[str] = set()
+    # 是否已提示过Pillow不可用
+    _preprocess_warned = False
+    # 后台清理任务
+    _sweep_task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def init(config: AstrBotConfig):
+        """初始化配置对象"""
+        ImageStorage.config = config
+
+    @staticmethod
+    def _get_image_config(key: str, default):
+        """读取image_processing配置项"""
+        if not ImageStorage.config:
+            return default
+        return ImageStorage.config.get("image_processing", {}).get(key, default)
+
+    @staticmethod
+    def _ensure_dir(directory: str) -> None:
+        """确保目录存在，不存在则创建"""
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    async def get_images_dir() -> str:
+        """获取图片存储目录，目录在本次运行中只创建一次"""
+        if ImageStorage._images_dir is None:
+            # 使用 AstrBot 的数据路径，兼容 Docker
+            from astrbot.core.utils.astrbot_path import get_astrbot_data_path
+            images_dir = os.path.join(get_astrbot_data_path(), "chat_history", "images")
+            await IOExecutor.run(ImageStorage._ensure_dir, images_dir)
+            ImageStorage._images_dir = images_dir
+        return ImageStorage._images_dir
+
+    @staticmethod
+    def register(filename: str, timestamp: Optional[float] = None) -> None:
+        """
+        在过期索引中登记一次图片引用，更新最后引用时间
+
+        Args:
+            filename: 图片目录下的文件名
+            timestamp: 引用时间，默认为当前时间
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        if ImageStorage._reused:
+            with ImageStorage._file_lock:
+                ImageStorage._reused.discard(filename)
+        ImageStorage._manifest[filename] = timestamp
+        heapq.heappush(ImageStorage._heap, (timestamp, filename))
+        ImageStorage._pending_touches[filename] = timestamp
+        ImageStorage._pending_removals.discard(filename)
+
+        # 频繁引用同一张图片会在堆中留下大量旧条目，超过一定比例时重建
+        if len(ImageStorage._heap) > 2 * len(ImageStorage._manifest) + 1024:
+            ImageStorage._heap = [(ts, name) for name, ts in ImageStorage._manifest.items()]
+            heapq.heapify(ImageStorage._heap)
+        ImageStorage.ensure_sweeper()
+
+    @staticmethod
+    def _get_preprocess_options() -> Optional[Dict]:
+        """
+        读取图片预处理配置
+
+        Returns:
+            预处理参数，未开启预处理或Pillow不可用时返回None
+        """
+        if not ImageStorage._get_image_config("image_preprocess", False):
+            return None
+        if not ImagePreprocessor.is_available():
+            if not ImageStorage._preprocess_warned:
+                logger.warning("未安装Pillow，无法进行图片预处理，将保存原图")
+                ImageStorage._preprocess_warned = True
+            return None
+        output_format = ImageStorage._get_image_config("image_preprocess_format", "jpeg")
+        return {
+            "max_dimension": max(64, int(ImageStorage._get_image_config("image_max_dimension", 1280))),
+            "quality": int(ImageStorage._get_image_config("image_quality", 80)),
+            "output_format": output_format if output_format in ImagePreprocessor.FORMATS else "jpeg",
+            "keep_original": bool(ImageStorage._get_image_config("keep_original_image", False)),
+        }
+
+    @staticmethod
+    def _copy_file(source_path: str, target_path: str) -> None:
+        """先复制到临时文件再替换，避免并发保存同一张图片时读到不完整的文件"""
+        temp_path = f"{target_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        shutil.copy2(source_path, temp_path)
+        os.replace(temp_path, target_path)
+
+    @staticmethod
+    def _claim(filenames: List[str]) -> None:
+        """
+        标记这些文件正在被复用或写入，并取消待删除状态，在检查文件是否存在之前调用
+
+        与清理任务标记待删除、_delete_files删除文件在同一把锁下进行，
+        文件要么在这之前已被删除(之后检查时不存在，会重新写入)，要么在登记前不会被删除
+        """
+        with ImageStorage._file_lock:
+            ImageStorage._pending_deletes.difference_update(filenames)
+            ImageStorage._reused.update(filenames)
+
+    @staticmethod
+    def _release(filenames: List[str]) -> None:
+        """取消复用标记，用于没有登记到索引的文件"""
+        with ImageStorage._file_lock:
+            ImageStorage._reused.difference_update(filenames)
+
+    @staticmethod
+    def _store_file(images_dir: str, source_path: str, preprocess: Optional[Dict] = None) -> Tuple[List[str], bool]:
+        """
+        按内容哈希将图片保存到图片目录
+
+        开启预处理时保存缩放压缩后的图片，文件名仍使用原图的哈希，
+        因此同一张原图只会处理一次
+
+        Args:
+            images_dir: 图片存储目录
+            source_path: 源文件路径
+            preprocess: 预处理参数，为None时保存原图
+
+        Returns:
+            (保存的文件名列表, 是否写入了新文件)，第一个文件用于消息记录，
+            内容相同的图片已存在时不写入
+        """
+        digest = hashlib.sha256()
+        with open(source_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        content_hash = digest.hexdigest()
+
+        # 尝试从原文件获取扩展名，默认使用 jpg 扩展名
+        file_extension = os.path.splitext(source_path)[1].lower()
+        if file_extension not in ImageStorage.IMAGE_EXTENSIONS:
+            file_extension = ".jpg"
+        original_filename = f"{content_hash}{file_extension}"
+        if preprocess is None:
+            candidates = [original_filename]
+        else:
+            # 需要保留的原图使用单独的文件名，避免与无法压缩时保存的原图混淆
+            kept_filename = f"{content_hash}.orig{file_extension}"
+            derivative_filename = f"{content_hash}{ImagePreprocessor.get_extension(preprocess['output_format'])}"
+            candidates = [derivative_filename, original_filename, kept_filename]
+
+        # 先标记再检查文件是否存在，避免检查后文件被清理任务删除
+        # 返回的文件由调用方登记时清除标记，其余文件在这里清除
+        ImageStorage._claim(candidates)
+        filenames: List[str] = []
+        try:
+            filenames, written = ImageStorage._store_claimed_file(images_dir, source_path, preprocess, candidates)
+            return filenames, written
+        finally:
+            ImageStorage._release([name for name in candidates if name not in filenames])
+
+    @staticmethod
+    def _store_claimed_file(
+            images_dir: str,
+            source_path: str,
+            preprocess: Optional[Dict],
+            candidates: List[str]
+        ) -> Tuple[List[str], bool]:
+        """
+        保存已标记为复用的图片，参数和返回值见_store_file
+
+        Args:
+            candidates: 可能使用的文件名，不预处理时为[原图]，否则为[压缩后的图片, 原图, 保留的原图]
+        """
+        if preprocess is None:
+            original_filename = candidates[0]
+            target_path = os.path.join(images_dir, original_filename)
+            if os.path.exists(target_path):
+                return [original_filename], False
+            ImageStorage._copy_file(source_path, target_path)
+            return [original_filename], True
+
+        derivative_filename, original_filename, kept_filename = candidates
+        keep_original = preprocess["keep_original"]
+        for filename in (derivative_filename, original_filename):
+            if os.path.exists(os.path.join(images_dir, filename)):
+                if keep_original and os.path.exists(os.path.join(images_dir, kept_filename)):
+                    return [filename, kept_filename], False
+                return [filename], False
+
+        written = [derivative_filename]
+        if not ImagePreprocessor.create_derivative(
+                source_path,
+                os.path.join(images_dir, derivative_filename),
+                preprocess["max_dimension"],
+                preprocess["quality"],
+                preprocess["output_format"]):
+            # 动图、无法识别或压缩后没有变小的图片保存原图
+            ImageStorage._copy_file(source_path, os.path.join(images_dir, original_filename))
+            return [original_filename], True
+
+        if keep_original:
+            ImageStorage._copy_file(source_path, os.path.join(images_dir, kept_filename))
+            written.append(kept_filename)
+        return written, True
+
+    @staticmethod
+    async def persist_file(source_path: str) -> str:
+        """
+        持久化一张图片，内容相同的图片只保存一份
+
+        Args:
+            source_path: 图片的本地文件路径
+
+        Returns:
+            持久化后的绝对路径
+        """
+        images_dir = await ImageStorage.get_images_dir()
+        filenames, written = await IOExecutor.run(
+            ImageStorage._store_file, images_dir, source_path, ImageStorage._get_preprocess_options()
+        )
+        for filename in filenames:
+            ImageStorage.register(filename)
+        if not written:
+            logger.debug(f"图片已存在，跳过复制: {filenames[0]}")
+        return os.path.abspath(os.path.join(images_dir, filenames[0]))
+
+    @staticmethod
+    def touch(file_path: str) -> None:
+        """
+        再次引用一张已持久化的图片时更新最后引用时间
+
+        Args:
+            file_path: 持久化图片的路径
+        """
+        filename = os.path.basename(file_path)
+        if filename in ImageStorage._manifest:
+            ImageStorage.register(filename)
+            return
+
+        # 已从索引中取出但尚未删除的文件重新登记，已删除的文件不再登记
+        with ImageStorage._file_lock:
+            if filename not in ImageStorage._pending_deletes:
+                return
+            ImageStorage._pending_deletes.discard(filename)
+        ImageStorage.register(filename)
+
+    @staticmethod
+    def get_stats() -> Dict[str, int]:
+        """
+        获取图片存储的统计指标
+
+        Returns:
+            统计指标字典，包含索引中的图片数量和等待删除的图片数量
+        """
+        with ImageStorage._file_lock:
+            pending_deletes = len(ImageStorage._pending_deletes)
+        return {
+            "images": len(ImageStorage._manifest),
+            "pending_deletes": pending_deletes,
+        }
+
+    @staticmethod
+    def _open_index(images_dir: str) -> Tuple[ImageIndex, Dict[str, float], List[Tuple[float, str]]]:
+        """
+        打开索引数据库并读取索引，在IO线程池中调用
+
+        数据库为空时导入旧版的JSON清单，没有清单时扫描一次图片目录生成
+
+        Args:
+            images_dir: 图片存储目录
+
+        Returns:
+            (索引数据库, 过期索引, 按最后引用时间建好的堆)
+        """
+        index = ImageIndex(os.path.join(images_dir, ImageStorage.INDEX_FILENAME))
+        manifest = index.load()
+        if not manifest:
+            manifest = ImageStorage._read_legacy_manifest(images_dir)
+            if manifest is None:
+                # 首次运行时，用文件创建时间建立索引
+                manifest = {}
+                for entry in os.scandir(images_dir):
+                    if entry.is_file() and not entry.name.startswith(".") and not entry.name.endswith(".tmp"):
+                        manifest[entry.name] = entry.stat().st_ctime
+                logger.info(f"已根据图片目录建立过期索引，共{len(manifest)}个文件")
+            index.write(manifest, [])
+
+        # 导入后删除旧版清单
+        manifest_path = os.path.join(images_dir, ImageStorage.MANIFEST_FILENAME)
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+
+        heap = [(ts, name) for name, ts in manifest.items()]
+        heapq.heapify(heap)
+        return index, manifest, heap
+
+    @staticmethod
+    def _read_legacy_manifest(images_dir: str) -> Optional[Dict[str, float]]:
+        """
+        读取旧版的JSON清单文件
+
+        Args:
+            images_dir: 图片存储目录
+
+        Returns:
+            过期索引，格式: {filename: 最后引用时间}，清单不存在或已损坏时返回None
+        """
+        manifest_path = os.path.join(images_dir, ImageStorage.MANIFEST_FILENAME)
+        if not os.path.exists(manifest_path):
+            return None
+        try:
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                files = json.load(f).get("files", {})
+            # 第1版清单只有时间，第2版为[最后引用时间, 引用次数]，引用次数不再使用
+            return {
+                name: float(value[0]) if isinstance(value, list) else float(value)
+                for name, value in files.items()
+            }
+        except Exception as e:
+            logger.error(f"读取旧版图片清单失败，将重新扫描图片目录: {e}")
+            return None
+
+    @staticmethod
+    def _delete_files(images_dir: str, filenames: List[str]) -> int:
+        """
+        删除一批图片文件，已被重新引用的文件跳过
+
+        Returns:
+            实际删除的文件数量
+        """
+        deleted = 0
+        for filename in filenames:
+            try:
+                # 持有锁删除，保证_store_file取消待删除状态后文件不会再被删除
+                with ImageStorage._file_lock:
+                    if filename not in ImageStorage._pending_deletes or filename in ImageStorage._reused:
+                        continue
+                    ImageStorage._pending_deletes.discard(filename)
+                    os.remove(os.path.join(images_dir, filename))
+                deleted += 1
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logger.error(f"删除过期图片文件失败 {filename}: {e}")
+        return deleted
+
+    @staticmethod
+    def _get_retention_days() -> int:
+        """获取图片保留天数配置"""
+        retention_days = ImageStorage._get_image_config("image_retention_days", 7)
+        if retention_days < 1 or retention_days > 365:
+            logger.warning(f"图片保留天数配置无效: {retention_days}，使用默认值7天")
+            retention_days = 7
+        return retention_days
+
+    @staticmethod
+    async def sweep_once() -> int:
+        """
+        执行一次清理：从索引中取出已过期的图片，最多删除sweep_batch_size个
+
+        Returns:
+            删除的文件数量
+        """
+        if not ImageStorage._get_image_config("enable_image_persistence", True):
+            return 0
+
+        images_dir = await ImageStorage.get_images_dir()
+        if ImageStorage._index is None:
+            index, loaded, heap = await IOExecutor.run(ImageStorage._open_index, images_dir)
+            # 索引和堆在IO线程中建好，这里只合并加载期间新登记的少量图片，以内存中的时间为准
+            loaded.update(ImageStorage._manifest)
+            for entry in ImageStorage._heap:
+                heapq.heappush(heap, entry)
+            ImageStorage._manifest = loaded
+            ImageStorage._heap = heap
+            ImageStorage._index = index
+
+        retention_days = ImageStorage._get_retention_days()
+        threshold = time.time() - retention_days * 24 * 3600
+        batch_size = max(1, ImageStorage._get_image_config("sweep_batch_size", 200))
+
+        expired = []
+        heap = ImageStorage._heap
+        while heap and heap[0][0] < threshold and len(expired) < batch_size:
+            timestamp, filename = heapq.heappop(heap)
+            # 登记时间已更新的旧条目直接跳过
+            if ImageStorage._manifest.get(filename) != timestamp:
+                continue
+            del ImageStorage._manifest[filename]
+            ImageStorage._pending_touches.pop(filename, None)
+            ImageStorage._pending_removals.add(filename)
+            expired.append(filename)
+
+        deleted = 0
+        if expired:
+            with ImageStorage._file_lock:
+                # 正在被复用的文件不删除，调用方登记后会重新加入索引
+                expired = [filename for filename in expired if filename not in ImageStorage._reused]
+                ImageStorage._pending_deletes.update(expired)
+            deleted = await IOExecutor.run(ImageStorage._delete_files, images_dir, expired)
+            logger.info(f"图片清理完成，清理了 {deleted} 个超过 {retention_days} 天的图片文件")
+
+        await ImageStorage.flush_index()
+        return deleted
+
+    @staticmethod
+    async def flush_index() -> None:
+        """将索引的修改写入数据库，只写入发生变化的行"""
+        index = ImageStorage._index
+        if index is None or not (ImageStorage._pending_touches or ImageStorage._pending_removals):
+            return
+        touches, removals = ImageStorage._pending_touches, ImageStorage._pending_removals
+        ImageStorage._pending_touches, ImageStorage._pending_removals = {}, set()
+        try:
+            await IOExecutor.run(index.write, touches, removals)
+        except Exception as e:
+            # 写入失败时放回，下次清理时重试，期间的新修改优先
+            new_touches, new_removals = ImageStorage._pending_touches, ImageStorage._pending_removals
+            touches.update(new_touches)
+            for filename in new_removals:
+                touches.pop(filename, None)
+            ImageStorage._pending_touches = touches
+            ImageStorage._pending_removals = (removals - new_touches.keys()) | new_removals
+            logger.error(f"保存图片索引失败: {e}")
+
+    @staticmethod
+    async def _sweep_loop() -> None:
+        """后台任务：按配置的间隔清理过期图片"""
+        while True:
+            try:
+                await ImageStorage.sweep_once()
+            except Exception as e:
+                logger.error(f"清理图片文件时发生错误: {e}")
+                logger.debug(traceback.format_exc())
+            interval = ImageStorage._get_image_config("sweep_interval", 60)
+            await asyncio.sleep(max(1, interval))
+
+    @staticmethod
+    def ensure_sweeper() -> None:
+        """确保后台清理任务已启动，需要在事件循环中调用"""
+        task = ImageStorage._sweep_task
+        if task is None or task.done():
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                return
+            ImageStorage._sweep_task = loop.create_task(ImageStorage._sweep_loop())
+
+    @staticmethod
+    async def shutdown() -> None:
+        """停止后台清理任务并保存索引，在插件卸载时调用"""
+        task = ImageStorage._sweep_task
+        ImageStorage._sweep_task = None
+        if task and not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        await ImageStorage.flush_index()
+        index = ImageStorage._index
+        ImageStorage._index = None
+        if index is not None:
+            await IOExecutor.run(index.close)
@@ -0,0 +1,112 @@
+from astrbot.api.all import *
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+import asyncio
+import threading
+
+class IOExecutor:
+    """
+    磁盘IO执行器工具类
+
+    使用专用线程池执行阻塞的文件操作，避免阻塞AstrBot的事件循环
+    同时统计排队深度等指标，便于调整线程数量
+    """
+
+    # 保存配置对象的静态变量
+    config = None
+    # 专用线程池
+    _executor: Optional[ThreadPoolExecutor] = None
+    _workers = 0
+    # 统计指标
+    _lock = threading.Lock()
+    _stats: Dict[str, int] = {
+        "submitted": 0,       # 已提交的任务数
+        "completed": 0,       # 已完成的任务数
+        "failed": 0,          # 执行失败的任务数
+        "queued": 0,          # 正在排队等待线程的任务数
+        "running": 0,         # 正在执行的任务数
+        "max_queue_depth": 0, # 历史最大排队深度
+    }
+
+    @staticmethod
+    def init(config: AstrBotConfig):
+        """初始化配置对象，并按配置创建线程池"""
+        IOExecutor.config = config
+        IOExecutor._get_executor()
+
+    @staticmethod
+    def _get_executor() -> ThreadPoolExecutor:
+        """获取线程池，未创建时按配置的线程数创建"""
+        if IOExecutor._executor is None:
+            workers = 4
+            if IOExecutor.config:
+                workers = IOExecutor.config.get("history_storage", {}).get("io_workers", 4)
+            IOExecutor._workers = max(1, min(int(workers), 32))
+            IOExecutor._executor = ThreadPoolExecutor(
+                max_workers=IOExecutor._workers,
+                thread_name_prefix="spectrecore_io"
+            )
+            logger.debug(f"磁盘IO线程池已创建，线程数: {IOExecutor._workers}")
+        return IOExecutor._executor
+
+    @staticmethod
+    def _wrap(func: Callable, *args) -> Any:
+        """在工作线程中执行任务并更新统计"""
+        with IOExecutor._lock:
+            IOExecutor._stats["queued"] -= 1
+            IOExecutor._stats["running"] += 1
+        try:
+            result = func(*args)
+            with IOExecutor._lock:
+                IOExecutor._stats["completed"] += 1
+            return result
+        except Exception:
+            with IOExecutor._lock:
+                IOExecutor._stats["failed"] += 1
+            raise
+        finally:
+            with IOExecutor._lock:
+                IOExecutor._stats["running"] -= 1
+
+    @staticmethod
+    async def run(func: Callable, *args) -> Any:
+        """
+        在IO线程池中执行阻塞函数
+
+        Args:
+            func: 要执行的阻塞函数
+            *args: 函数参数
+
+        Returns:
+            函数的返回值
+        """
+        executor = IOExecutor._get_executor()
+        with IOExecutor._lock:
+            IOExecutor._stats["submitted"] += 1
+            IOExecutor._stats["queued"] += 1
+            if IOExecutor._stats["queued"] > IOExecutor._stats["max_queue_depth"]:
+                IOExecutor._stats["max_queue_depth"] = IOExecutor._stats["queued"]
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, IOExecutor._wrap, func, *args)
+
+    @staticmethod
+    def get_stats() -> Dict[str, int]:
+        """
+        获取IO执行器的统计指标
+
+        Returns:
+            统计指标字典，包含线程数、排队深度、已完成任务数等
+        """
+        with IOExecutor._lock:
+            stats = dict(IOExecutor._stats)
+        stats["workers"] = IOExecutor._workers
+        return stats
+
+    @staticmethod
+    def shutdown() -> None:
+        """关闭线程池，等待已提交的任务完成"""
+        executor = IOExecutor._executor
+        IOExecutor._executor = None
+        if executor:
+            executor.shutdown(wait=True)
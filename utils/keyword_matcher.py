@@ -0,0 +1,175 @@
+from astrbot.api.all import *
+from typing import Dict, Iterable, List, NamedTuple, Optional
+import re
+
+class KeywordMatch(NamedTuple):
+    """一次扫描的匹配结果"""
+    trigger: bool     # 是否包含触发回复的关键词
+    blacklist: bool   # 是否包含黑名单关键词
+
+
+class KeywordMatcher:
+    """
+    关键词匹配器
+
+    由触发关键词和黑名单关键词一起构建，扫描一次消息文本即可同时得到两类关键词的命中情况
+    普通关键词使用Aho-Corasick自动机匹配，耗时只与文本长度有关，与关键词数量无关；
+    关键词较少时直接使用 in 判断，比逐字符遍历自动机更快
+
+    关键词支持以下前缀:
+    - re:  正则表达式，如 re:^在吗
+    - w:   整词匹配，关键词前后不能紧挨英文字母、数字或下划线，如 w:bot 匹配"叫bot出来"但不匹配"robot"
+    """
+
+    # 标记关键词所属的类别
+    TRIGGER = 1
+    BLACKLIST = 2
+
+    # 普通关键词少于该数量时不构建自动机
+    LITERAL_SCAN_THRESHOLD = 64
+
+    REGEX_PREFIX = "re:"
+    WORD_PREFIX = "w:"
+
+    def __init__(self, keywords: Iterable[str] = (), blacklist_keywords: Iterable[str] = ()):
+        """
+        Args:
+            keywords: 触发回复的关键词
+            blacklist_keywords: 黑名单关键词
+        """
+        self.keywords = [k for k in keywords if isinstance(k, str) and k]
+        self.blacklist_keywords = [k for k in blacklist_keywords if isinstance(k, str) and k]
+
+        # 需要检测的类别
+        self._wanted = (self.TRIGGER if self.keywords else 0) | (self.BLACKLIST if self.blacklist_keywords else 0)
+
+        literals: Dict[str, int] = {}
+        patterns: Dict[int, List[str]] = {self.TRIGGER: [], self.BLACKLIST: []}
+        for kind, words in ((self.TRIGGER, self.keywords), (self.BLACKLIST, self.blacklist_keywords)):
+            for word in words:
+                pattern = self._to_pattern(word)
+                if pattern is None:
+                    literals[word] = literals.get(word, 0) | kind
+                else:
+                    patterns[kind].append(pattern)
+
+        # 正则和整词规则按类别尽量合并为一个正则表达式
+        self._regexes: Dict[int, List["re.Pattern"]] = {}
+        for kind, kind_patterns in patterns.items():
+            if kind_patterns:
+                self._regexes[kind] = self._compile_rules(kind_patterns)
+
+        self._literals = list(literals.items())
+        self._goto: List[Dict[str, int]] = []
+        self._fail: List[int] = []
+        self._output: List[int] = []
+        if len(self._literals) >= self.LITERAL_SCAN_THRESHOLD:
+            self._build_automaton()
+
+    @staticmethod
+    def _to_pattern(word: str) -> Optional[str]:
+        """将带前缀的规则转换为正则表达式，普通关键词返回None"""
+        if word.startswith(KeywordMatcher.REGEX_PREFIX):
+            pattern = word[len(KeywordMatcher.REGEX_PREFIX):]
+            try:
+                re.compile(pattern)
+                return pattern
+            except re.error as e:
+                logger.warning(f"关键词正则表达式无效，按普通关键词处理: {word} ({e})")
+                return None
+        if word.startswith(KeywordMatcher.WORD_PREFIX):
+            # 只把英文字母、数字和下划线当作单词字符，中文紧挨着关键词时仍然匹配
+            return rf"(?<![A-Za-z0-9_]){re.escape(word[len(KeywordMatcher.WORD_PREFIX):])}(?![A-Za-z0-9_])"
+        return None
+
+    @staticmethod
+    def _compile_rules(patterns: List[str]) -> List["re.Pattern"]:
+        """
+        编译同一类别的正则规则
+
+        没有捕获组的规则合并为一个正则表达式，只需搜索一次；
+        合并会改变分组编号，使反向引用失效，带有全局标记(如(?i))的规则也无法合并，
+        这些情况下每条规则单独编译
+
+        Args:
+            patterns: 已校验过的正则表达式
+
+        Returns:
+            编译后的正则表达式列表，命中任意一个即视为命中
+        """
+        compiled = [re.compile(p) for p in patterns]
+        if len(compiled) > 1 and all(c.groups == 0 for c in compiled):
+            try:
+                return [re.compile("|".join(f"(?:{p})" for p in patterns))]
+            except re.error:
+                pass
+        return compiled
+
+    def _build_automaton(self) -> None:
+        """构建Aho-Corasick自动机"""
+        goto, fail, output = [{}], [0], [0]
+        for word, kind in self._literals:
+            state = 0
+            for ch in word:
+                next_state = goto[state].get(ch)
+                if next_state is None:
+                    next_state = len(goto)
+                    goto[state][ch] = next_state
+                    goto.append({})
+                    fail.append(0)
+                    output.append(0)
+                state = next_state
+            output[state] |= kind
+
+        # 按广度优先顺序计算失败指针，并把失败指针上的输出合并到当前状态
+        queue = list(goto[0].values())
+        for state in queue:
+            for ch, next_state in goto[state].items():
+                queue.append(next_state)
+                fallback = fail[state]
+                while fallback and ch not in goto[fallback]:
+                    fallback = fail[fallback]
+                fail[next_state] = goto[fallback].get(ch, 0)
+                output[next_state] |= output[fail[next_state]]
+
+        self._goto, self._fail, self._output = goto, fail, output
+
+    def _scan_literals(self, text: str) -> int:
+        """匹配普通关键词，返回命中的类别"""
+        found = 0
+        if self._goto:
+            goto, fail, output = self._goto, self._fail, self._output
+            state = 0
+            for ch in text:
+                while state and ch not in goto[state]:
+                    state = fail[state]
+                state = goto[state].get(ch, 0)
+                found |= output[state]
+                if found == self._wanted:
+                    break
+        else:
+            for word, kind in self._literals:
+                if kind & ~found and word in text:
+                    found |= kind
+                    if found == self._wanted:
+                        break
+        return found
+
+    def scan(self, text: str) -> KeywordMatch:
+        """
+        扫描消息文本
+
+        Args:
+            text: 消息文本
+
+        Returns:
+            触发关键词和黑名单关键词的命中情况
+        """
+        if not self._wanted or not text:
+            return KeywordMatch(False, False)
+
+        found = self._scan_literals(text)
+        for kind, regexes in self._regexes.items():
+            if not found & kind and any(regex.search(text) for regex in regexes):
+                found |= kind
+        return KeywordMatch(bool(found & self.TRIGGER), bool(found & self.BLACKLIST))
@@ -0,0 +1,64 @@
+from typing import Dict, List, Optional
+import math
+import time
+
+class MessageRateEstimator:
+    """
+    消息频率估计器
+
+    每个聊天只保存一个按时间指数衰减的消息计数和上次更新时间，每条消息O(1)更新，
+    计数除以时间常数即为最近一段时间内的平均消息频率，越久之前的消息权重越小
+    """
+
+    def __init__(self):
+        # 格式: {chat_key: [衰减后的消息计数, 上次更新时间]}
+        self._counters: Dict[str, List[float]] = {}
+
+    def observe(self, key: str, window: float, now: Optional[float] = None) -> float:
+        """
+        记录一条消息
+
+        Args:
+            key: 聊天的唯一标识
+            window: 时间常数（秒），约等于滑动窗口的长度
+            now: 当前时间(单调时钟)，默认取当前时间
+
+        Returns:
+            记录后的消息频率（条/秒）
+        """
+        now = time.monotonic() if now is None else now
+        counter = self._counters.get(key)
+        if counter is None:
+            counter = self._counters[key] = [0.0, now]
+        counter[0] = self._decay(counter, window, now) + 1
+        counter[1] = now
+        return counter[0] / window
+
+    def get_rate(self, key: str, window: float, now: Optional[float] = None) -> float:
+        """
+        获取聊天当前的消息频率，不记录消息
+
+        Args:
+            key: 聊天的唯一标识
+            window: 时间常数（秒）
+            now: 当前时间(单调时钟)，默认取当前时间
+
+        Returns:
+            消息频率（条/秒），没有记录时为0
+        """
+        counter = self._counters.get(key)
+        if counter is None:
+            return 0.0
+        now = time.monotonic() if now is None else now
+        return self._decay(counter, window, now) / window
+
+    @staticmethod
+    def _decay(counter: List[float], window: float, now: float) -> float:
+        """计算衰减到当前时间的消息计数"""
+        elapsed = now - counter[1]
+        if elapsed <= 0:
+            return counter[0]
+        return counter[0] * math.exp(-elapsed / window)
+
+    def __len__(self) -> int:
+        return len(self._counters)
@@ -1,22 +1,49 @@
 from astrbot.api.all import *
-from typing import List, Dict, Any
+import astrbot.api.message_components as Comp
+from typing import List, Dict, Any, Callable, Optional, Tuple
+import json
 import time
+from collections import OrderedDict
 from datetime import datetime
 from .image_caption import ImageCaptionUtils
+from .history_record import HistoryRecord
 import asyncio
 
+# 消息段概要渲染函数，参数为消息段和图片描述字典，返回概要文本
+OutlineRenderer = Callable[[BaseMessageComponent, Dict[str, Optional[str]]], str]
+
 class MessageUtils:
     """
     消息处理工具类
     """
+
+    # 历史消息之间的分割线
+    HISTORY_DIVIDER = "\n" + "-" + "\n"
+    # 最近格式化结果的缓存，格式: {id(最后一条记录): (第一条记录, 最后一条记录, 条数, 文本)}
+    _formatted_cache: "OrderedDict[int, Tuple[HistoryRecord, HistoryRecord, int, str]]" = OrderedDict()
+    MAX_FORMATTED_CACHE = 128
+    # 消息段类型 -> 概要渲染函数，默认的渲染函数在模块末尾注册
+    _outline_renderers: Dict[type, OutlineRenderer] = {}
+    # 未直接注册的子类的查找结果缓存
+    _resolved_renderers: Dict[type, OutlineRenderer] = {}
         
     @staticmethod
-    async def format_history_for_llm(history_messages: List[AstrBotMessage], max_messages: int = 20) -> str:
+    async def format_history_for_llm(history_messages: List[HistoryRecord], max_messages: int = 20) -> str:
         """
         将历史消息列表格式化为适合输入给大模型的文本格式
         
+        调用方应通过 HistoryStorage.get_history(limit=...) 只读取需要的条数，
+        这里的截取仅作为兜底
+
+        先收集所有消息中的图片并发转述，全部完成或超过总时限后再拼接文本，
+        未能按时完成转述的图片显示为[图片]
+
+        历史消息不会再变化，每条消息格式化后的片段只生成一次并缓存在记录中，
+        含有未转述图片的消息不缓存，下次格式化时重新尝试转述。
+        同一段历史消息再次格式化时直接返回上次拼接的结果
+        
         Args:
-            history_messages: 历史消息列表
+            history_messages: 历史消息记录列表
             max_messages: 最大消息数量，默认20条
             
         Returns:
@@ -28,47 +55,156 @@ class MessageUtils:
         # 限制消息数量
         if len(history_messages) > max_messages:
             history_messages = history_messages[-max_messages:]
+
+        # 与上次格式化的消息相同时直接返回，缓存中保留了首尾记录的引用，不会误判
+        first, last = history_messages[0], history_messages[-1]
+        cached = MessageUtils._formatted_cache.get(id(last))
+        if cached and cached[0] is first and cached[1] is last and cached[2] == len(history_messages):
+            MessageUtils._formatted_cache.move_to_end(id(last))
+            return cached[3]
         
-        formatted_text = ""
-        divider = "\n" + "-" + "\n"
+        # 第一阶段：收集尚未渲染过的消息中的图片，并发生成图片描述
+        record_images = {}
+        for msg in history_messages:
+            if msg.segment is None and msg.components and msg.outline is None:
+                record_images[id(msg)] = []
+                MessageUtils.collect_images(msg.message, record_images[id(msg)])
+        images = [image for images in record_images.values() for image in images]
+        captions = await ImageCaptionUtils.generate_image_captions(images) if images else {}
+
+        # 第二阶段：使用已生成的图片描述生成每条消息的片段
+        segments = []
+        complete = True
+        for msg in history_messages:
+            if msg.segment is not None:
+                segments.append(msg.segment)
+                continue
+
+            # 获取消息内容，优先使用已缓存的概要
+            if msg.outline is None and msg.components:
+                message_content = MessageUtils.render_outline(msg.message, captions)
+                # 所有图片都已有描述时，概要不会再变化，缓存到记录中
+                if all(captions.get(image) for image in record_images[id(msg)]):
+                    msg.outline = message_content
+            else:
+                message_content = msg.outline or ""
+
+            segment = MessageUtils._format_segment(msg, message_content)
+            if msg.outline is not None or not msg.components:
+                msg.segment = segment
+            else:
+                complete = False
+            segments.append(segment)
+
+        # 每条消息之间添加分割线
+        formatted_text = MessageUtils.HISTORY_DIVIDER.join(segments)
+        if complete:
+            MessageUtils._formatted_cache[id(last)] = (first, last, len(history_messages), formatted_text)
+            if len(MessageUtils._formatted_cache) > MessageUtils.MAX_FORMATTED_CACHE:
+                MessageUtils._formatted_cache.popitem(last=False)
+        return formatted_text
+
+    @staticmethod
+    def _format_segment(msg: HistoryRecord, message_content: str) -> str:
+        """
+        格式化单条消息
+
+        Args:
+            msg: 历史消息记录
+            message_content: 消息概要
+
+        Returns:
+            包含发送者、时间和内容的消息片段
+        """
+        # 获取发送者信息
+        sender_name = msg.sender_nickname or "未知用户"
+        sender_id = msg.sender_id or "unknown"
         
-        for idx, msg in enumerate(history_messages):
-            # 获取发送者信息
-            sender_name = "未知用户"
-            sender_id = "unknown"
-            if hasattr(msg, "sender") and msg.sender:
-                sender_name = msg.sender.nickname or "未知用户"
-                sender_id = msg.sender.user_id or "unknown"
-            
-            # 获取发送时间
-            send_time = "未知时间"
-            if hasattr(msg, "timestamp") and msg.timestamp:
+        # 获取发送时间
+        send_time = "未知时间"
+        if msg.timestamp:
+            try:
+                time_obj = datetime.fromtimestamp(msg.timestamp)
+                send_time = time_obj.strftime("%Y-%m-%d %H:%M:%S")
+            except:
+                # 如果timestamp不是合法的时间戳，尝试使用当前时间
+                pass
+
+        return f"发送者: {sender_name} (ID: {sender_id})\n时间: {send_time}\n内容: {message_content}"
+
+    @staticmethod
+    def prerender_record(record: HistoryRecord) -> None:
+        """
+        保存消息时提前生成不含图片的消息片段，格式化历史记录时直接使用
+
+        含有图片的消息需要等待图片转述，在格式化时生成
+
+        Args:
+            record: 新保存的历史消息记录
+        """
+        if record.segment is not None:
+            return
+        try:
+            if record.components:
+                images = []
+                MessageUtils.collect_images(record.message, images)
+                if images:
+                    return
+                record.outline = MessageUtils.render_outline(record.message, {})
+            record.segment = MessageUtils._format_segment(record, record.outline or "")
+        except Exception as e:
+            logger.debug(f"提前生成消息片段失败: {e}")
+
+    @staticmethod
+    def _get_image_source(image_component: Image) -> Tuple[Optional[str], bool]:
+        """
+        获取图片用于转述的来源
+
+        Args:
+            image_component: 图片消息段
+
+        Returns:
+            (图片的本地路径或URL, 持久化图片文件是否缺失)
+        """
+        # 优先使用 file 字段（持久化存储的绝对路径），降级到 url 字段（向后兼容）
+        image = image_component.file if image_component.file else image_component.url
+        if not image:
+            return None, False
+
+        # 如果是 file:/// 格式的持久化存储图片，提取绝对路径
+        if image.startswith("file:///"):
+            image_path = image[8:]  # 移除 file:/// 前缀
+            # 检查文件是否存在
+            if not os.path.exists(image_path):
+                return None, True
+            image = image_path
+        return image, False
+
+    @staticmethod
+    def collect_images(message_list: List[BaseMessageComponent], images: List[str]) -> None:
+        """
+        收集消息段列表(包括回复中的消息链)中需要转述的图片
+
+        Args:
+            message_list: 消息段列表
+            images: 收集结果，图片来源会追加到该列表中
+        """
+        for i in message_list:
+            if isinstance(i, Image):
                 try:
-                    time_obj = datetime.fromtimestamp(msg.timestamp)
-                    send_time = time_obj.strftime("%Y-%m-%d %H:%M:%S")
-                except:
-                    # 如果timestamp不是合法的时间戳，尝试使用当前时间
-                    pass
-            
-            # 获取消息内容 (异步调用)
-            message_content = await MessageUtils.outline_message_list(msg.message) if hasattr(msg, "message") and msg.message else ""
-            
-            # 格式化该条消息
-            message_text = f"发送者: {sender_name} (ID: {sender_id})\n"
-            message_text += f"时间: {send_time}\n"
-            message_text += f"内容: {message_content}"
-            
-            # 添加到结果中
-            formatted_text += message_text
-            
-            # 除了最后一条消息，每条消息后添加分割线
-            if idx < len(history_messages) - 1:
-                formatted_text += divider
-        
-        return formatted_text
+                    image, _ = MessageUtils._get_image_source(i)
+                    if image:
+                        images.append(image)
+                except Exception as e:
+                    logger.debug(f"获取图片来源失败: {e}")
+            elif isinstance(i, Reply) and i.chain:
+                MessageUtils.collect_images(i.chain, images)
            
     @staticmethod
-    async def outline_message_list(message_list: List[BaseMessageComponent]) -> str:
+    async def outline_message_list(
+            message_list: List[BaseMessageComponent],
+            captions: Optional[Dict[str, Optional[str]]] = None
+        ) -> str:
         """
         获取消息概要。
 
@@ -76,121 +212,166 @@ class MessageUtils:
         图片会尝试进行转述。
 
         Astrbot中get_message_outline()方法的扩展版本，支持更多消息类型和更详细的内容。
+        各类型消息段的渲染方式见 register_outline_renderer
         
         Args:
             message_list: 消息段列表
+            captions: 预先生成的图片描述，提供时只使用其中的描述，不再等待转述
             
         Returns:
             消息概要文本
         """
-        outline = ""
+        if captions is None:
+            images = []
+            MessageUtils.collect_images(message_list, images)
+            captions = await ImageCaptionUtils.generate_image_captions(images) if images else {}
+        return MessageUtils.render_outline(message_list, captions)
+
+    @staticmethod
+    def render_outline(message_list: List[BaseMessageComponent], captions: Dict[str, Optional[str]]) -> str:
+        """
+        使用已生成的图片描述渲染消息概要，不进行图片转述
+
+        Args:
+            message_list: 消息段列表
+            captions: 图片描述，格式: {image: caption}，缺少描述的图片显示为[图片]
+
+        Returns:
+            消息概要文本
+        """
+        parts = []
         for i in message_list:
-            if isinstance(i, Plain):
-                outline += i.text
-            elif isinstance(i, Image):
-                try:
-                    # 优先使用 file 字段（持久化存储的绝对路径），降级到 url 字段（向后兼容）
-                    image = i.file if i.file else i.url
-                    if image:
-                        # 如果是 file:/// 格式的持久化存储图片，提取绝对路径
-                        if image.startswith("file:///"):
-                            image_path = image[8:]  # 移除 file:/// 前缀
-                            logger.debug(f"使用持久化图片路径: {image_path}")
-
-                            # 检查文件是否存在
-                            if not os.path.exists(image_path):
-                                logger.warning(f"持久化图片文件不存在: {image_path}")
-                                outline += f"[图片: 文件不存在]"
-                                continue
-                            image = image_path
-
-                        # 异步调用图片转述
-                        caption = await ImageCaptionUtils.generate_image_caption(image)
-                        if caption:
-                            outline += f"[图片: {caption}]"
-                        else:
-                            outline += f"[图片]"
-                    else:
-                        outline += f"[图片]"
-                except Exception as e:
-                    logger.error(f"处理图片消息失败: {e}")
-                    outline += "[图片]"
-            elif isinstance(i, Face):
-                outline += f"[表情:{i.id}]"
-            elif isinstance(i, At):
-                outline += f"[At:{i.qq}{f'({i.name})' if i.name else ''}]"
-            elif isinstance(i, AtAll):
-                outline += "[At:全体成员]"
-            elif isinstance(i, Record):
-                outline += "[语音]"
-            elif isinstance(i, Video):
-                outline += "[视频]"
-            elif isinstance(i, RPS):
-                outline += "[猜拳]"
-            elif isinstance(i, Dice):
-                outline += "[骰子]"
-            elif isinstance(i, Shake):
-                outline += "[抖一抖]"
-            elif isinstance(i, Anonymous):
-                outline += "[匿名]"
-            elif isinstance(i, Share):
-                outline += f"[分享:《{i.title}》{i.content if i.content else ''}]"
-            elif isinstance(i, Contact):
-                outline += f"[联系人:{i.id}]"
-            elif isinstance(i, Location):
-                outline += f"[位置:{i.title}{f'({i.content})' if i.content else ''}]"
-            elif isinstance(i, Music):
-                outline += f"[音乐:{i.title}{f'({i.content})' if i.content else ''}]"
-            elif isinstance(i, RedBag):
-                outline += f"[红包:{i.title}]"
-            elif isinstance(i, Poke):
-                outline += f"[戳一戳 对:{i.qq}]"
-            elif isinstance(i, Forward):
-                outline += f"[合并转发消息]"
-            elif isinstance(i, Node):
-                outline += f"[合并转发消息]"
-            elif isinstance(i, Nodes):
-                outline += f"[合并转发消息]"
-            elif isinstance(i, Xml):
-                outline += f"[XML消息]"
-            elif isinstance(i, Json):
-                # 尝试从JSON中提取有用信息
-                if isinstance(i.data, str):
-                    try:
-                        import json
-                        json_data = json.loads(i.data)
-                        if "prompt" in json_data:
-                            outline += f"[JSON卡片:{json_data.get('prompt', '')}]"
-                        elif "app" in json_data:
-                            outline += f"[小程序:{json_data.get('app', '')}]"
-                        else:
-                            outline += "[JSON消息]"
-                    except:
-                        outline += "[JSON消息]"
-                else:
-                    outline += "[JSON消息]"
-            elif isinstance(i, CardImage):
-                outline += f"[卡片图片:{i.source if i.source else ''}]"
-            elif isinstance(i, TTS):
-                outline += f"[TTS:{i.text}]"
-            elif isinstance(i, File):
-                outline += f"[文件:{i.name}]"
-            elif isinstance(i, WechatEmoji):
-                outline += "[微信表情]"
-            elif isinstance(i, Reply):
-                if i.chain:
-                    sender_info = f"{i.sender_nickname}({i.sender_id})" if i.sender_nickname else f"{i.sender_id}"
-                    # 异步调用
-                    reply_content = await MessageUtils.outline_message_list(i.chain)
-                    outline += f"[回复({sender_info}: {reply_content})]"
-                elif i.message_str:
-                    sender_info = f"{i.sender_nickname}({i.sender_id})" if i.sender_nickname else f"{i.sender_id}"
-                    outline += f"[回复({sender_info}: {i.message_str})]"
-                elif i.sender_nickname or i.sender_id:
-                    sender_info = f"{i.sender_nickname}({i.sender_id})" if i.sender_nickname else f"{i.sender_id}"
-                    outline += f"[回复({sender_info})]"
-                else:
-                    outline += "[回复消息]"
-            else:
-                outline += f"[{i.type}]"
-        return outline
\ No newline at end of file
+            renderer = MessageUtils._outline_renderers.get(type(i)) or MessageUtils._resolve_renderer(type(i))
+            parts.append(renderer(i, captions))
+        return "".join(parts)
+
+    @staticmethod
+    def register_outline_renderer(component_type: type, renderer: Optional[OutlineRenderer] = None):
+        """
+        注册消息段类型的概要渲染函数，可以被其他插件用于支持新的消息段类型或修改已有类型的显示方式
+
+        渲染函数接收消息段和图片描述字典，返回该消息段的概要文本。
+        可以直接调用，也可以作为装饰器使用:
+
+            @MessageUtils.register_outline_renderer(MyComponent)
+            def render_my_component(component, captions):
+                return f"[我的消息:{component.text}]"
+
+        Args:
+            component_type: 消息段类型，未注册的子类会使用最近的父类的渲染函数
+            renderer: 渲染函数，省略时返回装饰器
+
+        Returns:
+            省略renderer时返回装饰器，否则返回renderer
+        """
+        def register(func: OutlineRenderer) -> OutlineRenderer:
+            MessageUtils._outline_renderers[component_type] = func
+            # 子类的查找结果可能依赖于被修改的类型，重新查找
+            MessageUtils._resolved_renderers.clear()
+            return func
+
+        if renderer is None:
+            return register
+        return register(renderer)
+
+    @staticmethod
+    def _resolve_renderer(component_type: type) -> OutlineRenderer:
+        """查找未直接注册的消息段类型的渲染函数，沿继承链查找并缓存结果"""
+        renderer = MessageUtils._resolved_renderers.get(component_type)
+        if renderer is None:
+            renderer = _render_unknown
+            for base in component_type.__mro__[1:]:
+                if base in MessageUtils._outline_renderers:
+                    renderer = MessageUtils._outline_renderers[base]
+                    break
+            MessageUtils._resolved_renderers[component_type] = renderer
+        return renderer
+
+
+def _sender_info(reply: Reply) -> str:
+    """回复消息的发送者描述"""
+    return f"{reply.sender_nickname}({reply.sender_id})" if reply.sender_nickname else f"{reply.sender_id}"
+
+
+def _render_image(i: Image, captions: Dict[str, Optional[str]]) -> str:
+    """图片使用预先生成的描述，没有描述时显示为[图片]"""
+    try:
+        image, missing = MessageUtils._get_image_source(i)
+        if missing:
+            logger.warning(f"持久化图片文件不存在: {i.file}")
+            return "[图片: 文件不存在]"
+        caption = captions.get(image) if image else None
+        return f"[图片: {caption}]" if caption else "[图片]"
+    except Exception as e:
+        logger.error(f"处理图片消息失败: {e}")
+        return "[图片]"
+
+
+def _render_json(i: Json, captions: Dict[str, Optional[str]]) -> str:
+    """JSON卡片和小程序"""
+    # 尝试从JSON中提取有用信息，新版AstrBot中data已经是解析后的字典
+    try:
+        json_data = json.loads(i.data) if isinstance(i.data, str) else i.data
+        if isinstance(json_data, dict):
+            if "prompt" in json_data:
+                return f"[JSON卡片:{json_data.get('prompt', '')}]"
+            elif "app" in json_data:
+                return f"[小程序:{json_data.get('app', '')}]"
+    except:
+        pass
+    return "[JSON消息]"
+
+
+def _render_reply(i: Reply, captions: Dict[str, Optional[str]]) -> str:
+    """回复消息，递归渲染被回复的消息链"""
+    if i.chain:
+        reply_content = MessageUtils.render_outline(i.chain, captions)
+        return f"[回复({_sender_info(i)}: {reply_content})]"
+    elif i.message_str:
+        return f"[回复({_sender_info(i)}: {i.message_str})]"
+    elif i.sender_nickname or i.sender_id:
+        return f"[回复({_sender_info(i)})]"
+    return "[回复消息]"
+
+
+def _render_unknown(i: BaseMessageComponent, captions: Dict[str, Optional[str]]) -> str:
+    """未注册的消息段类型显示为类型名"""
+    return f"[{i.type}]"
+
+
+# 消息段类型名 -> 渲染函数，按类型直接查找，不再逐个isinstance判断
+# 按名称注册，当前AstrBot版本中不存在的消息段类型会被跳过
+_DEFAULT_OUTLINE_RENDERERS: Dict[str, OutlineRenderer] = {
+    "Plain": lambda i, captions: i.text,
+    "Image": _render_image,
+    "Face": lambda i, captions: f"[表情:{i.id}]",
+    "At": lambda i, captions: f"[At:{i.qq}{f'({i.name})' if i.name else ''}]",
+    "AtAll": lambda i, captions: "[At:全体成员]",
+    "Record": lambda i, captions: "[语音]",
+    "Video": lambda i, captions: "[视频]",
+    "RPS": lambda i, captions: "[猜拳]",
+    "Dice": lambda i, captions: "[骰子]",
+    "Shake": lambda i, captions: "[抖一抖]",
+    "Anonymous": lambda i, captions: "[匿名]",
+    "Share": lambda i, captions: f"[分享:《{i.title}》{i.content if i.content else ''}]",
+    "Contact": lambda i, captions: f"[联系人:{i.id}]",
+    "Location": lambda i, captions: f"[位置:{i.title}{f'({i.content})' if i.content else ''}]",
+    "Music": lambda i, captions: f"[音乐:{i.title}{f'({i.content})' if i.content else ''}]",
+    "RedBag": lambda i, captions: f"[红包:{i.title}]",
+    "Poke": lambda i, captions: f"[戳一戳 对:{i.qq}]",
+    "Forward": lambda i, captions: "[合并转发消息]",
+    "Node": lambda i, captions: "[合并转发消息]",
+    "Nodes": lambda i, captions: "[合并转发消息]",
+    "Xml": lambda i, captions: "[XML消息]",
+    "Json": _render_json,
+    "CardImage": lambda i, captions: f"[卡片图片:{i.source if i.source else ''}]",
+    "TTS": lambda i, captions: f"[TTS:{i.text}]",
+    "File": lambda i, captions: f"[文件:{i.name}]",
+    "WechatEmoji": lambda i, captions: "[微信表情]",
+    "Reply": _render_reply,
+}
+
+for _type_name, _renderer in _DEFAULT_OUTLINE_RENDERERS.items():
+    _component_type = getattr(Comp, _type_name, None)
+    if isinstance(_component_type, type):
+        MessageUtils.register_outline_renderer(_component_type, _renderer)
@@ -1,13 +1,57 @@
 from astrbot.api.all import *
 from typing import Dict, Any, Optional
+import asyncio
 import random
+import time
 from .llm_utils import LLMUtils
+from .keyword_matcher import KeywordMatch
+from .message_rate import MessageRateEstimator
+from .reply_policy import ReplyPolicy
+from .reply_scheduler import ReplyScheduler
 
 class ReplyDecision:
     """
     消息回复决策工具类
     用于判断是否要使用大模型回复消息
     """
+
+    # 当前的回复策略，配置变化时整体替换
+    _policy: Optional[ReplyPolicy] = None
+    # 正在防抖等待的聊天
+    # 格式: {chat_key: {"started": 开始等待的时间, "last_message": 最后一条消息的时间, "merged": 合并的消息数}}
+    _debounce_pending: Dict[str, Dict[str, float]] = {}
+    # 自适应回复使用的各聊天消息频率
+    _message_rates = MessageRateEstimator()
+
+    @staticmethod
+    def init(config: AstrBotConfig):
+        """初始化时编译回复策略"""
+        ReplyDecision.reload(config)
+
+    @staticmethod
+    def reload(config: AstrBotConfig) -> ReplyPolicy:
+        """
+        重新编译回复策略并替换当前策略，配置变化后调用
+
+        Args:
+            config: 配置对象
+
+        Returns:
+            新的回复策略
+        """
+        policy = ReplyPolicy.compile(config)
+        ReplyDecision._policy = policy
+        logger.debug(f"已编译回复策略，启用群聊{len(policy.enabled_groups)}个，"
+                     f"触发关键词{len(policy.matcher.keywords)}个，黑名单关键词{len(policy.matcher.blacklist_keywords)}个")
+        return policy
+
+    @staticmethod
+    def get_policy(config: AstrBotConfig) -> ReplyPolicy:
+        """获取当前的回复策略，尚未编译时从配置编译"""
+        policy = ReplyDecision._policy
+        if policy is None:
+            policy = ReplyDecision.reload(config)
+        return policy
     
     @staticmethod
     def should_reply(event: AstrMessageEvent, config: AstrBotConfig) -> bool:
@@ -26,61 +70,76 @@ class ReplyDecision:
             platform_name = event.get_platform_name()
             is_private_chat = event.is_private_chat()
             chat_id = event.get_sender_id() if is_private_chat else event.get_group_id()
+            # 本次决策全程使用同一个策略，不受并发的配置替换影响
+            policy = ReplyDecision.get_policy(config)
+
+            chat_key = LLMUtils.get_chat_key(platform_name, is_private_chat, chat_id)
+
+            # 自适应回复需要统计所有消息的频率，在其他检查之前记录
+            if policy.method == "自适应回复" and policy.is_enabled(is_private_chat, None if is_private_chat else chat_id):
+                ReplyDecision._message_rates.observe(chat_key, policy.activity_window)
+
+            # 正在防抖等待的聊天，新消息推迟等待中的回复，合并到同一次调用
+            pending = ReplyDecision._debounce_pending.get(chat_key)
+            if pending is not None:
+                pending["last_message"] = time.monotonic()
+                pending["merged"] += 1
+                logger.debug(f"当前聊天正在等待消息平息，合并到等待中的回复")
+                return False
             
             # 检查是否已有大模型在处理
             if LLMUtils.is_llm_in_progress(platform_name, is_private_chat, chat_id):
                 logger.debug(f"当前聊天已有大模型处理中，不进行回复")
                 return False
                 
-            # 检查消息是否包含黑名单关键词
-            blacklist_keywords = config.get("model_frequency", {}).get("blacklist_keywords", [])
-            if blacklist_keywords and ReplyDecision._check_blacklist_keywords(event, blacklist_keywords):
+            # 扫描一次消息，同时检查触发关键词和黑名单关键词
+            keyword_match = ReplyDecision._match_keywords(event, policy)
+            if keyword_match.blacklist:
                 logger.debug("消息中包含黑名单关键词，不进行回复")
                 return False
             
             # 检查配置中的回复规则
-            return ReplyDecision._check_reply_rules(event, config)
+            if not ReplyDecision._check_reply_rules(event, policy, keyword_match, chat_key):
+                return False
+
+            # 决定回复后再检查限流，不回复的消息不消耗令牌
+            return ReplyScheduler.try_acquire(platform_name, is_private_chat, chat_id, policy)
         except Exception as e:
             logger.error(f"判断是否回复时发生错误: {e}")
             return False
     
     @staticmethod
-    def _check_reply_rules(event: AstrMessageEvent, config: AstrBotConfig) -> bool:
+    def _check_reply_rules(event: AstrMessageEvent, policy: ReplyPolicy, keyword_match: KeywordMatch, chat_key: str) -> bool:
         """
         检查回复规则
         
         Args:
             event: 消息事件
-            config: 配置对象
-            
+            policy: 回复策略
+            keyword_match: 关键词匹配结果
+            chat_key: 聊天的唯一标识
+
         Returns:
             是否应该回复
         """
         # 检查是否是开启回复的群聊/私聊
-        if event.is_private_chat():
-            if not config.get("enabled_private", False):
+        is_private_chat = event.is_private_chat()
+        group_id = None if is_private_chat else event.get_group_id()
+        if not policy.is_enabled(is_private_chat, group_id):
+            if is_private_chat:
                 logger.debug("未开启私聊回复功能")
-                return False
-        else:
-            if event.get_group_id() not in config.get("enabled_groups", []):
-                logger.debug(f"群聊{event.get_group_id()}未开启回复功能")
-                return False
+            else:
+                logger.debug(f"群聊{group_id}未开启回复功能")
+            return False
             
-        # 获取消息频率配置
-        frequency_config = config.get("model_frequency", {})
         # 检查关键词触发
-        keywords = frequency_config.get("keywords", [])
-        if keywords and ReplyDecision._check_keywords(event, keywords):
+        if keyword_match.trigger:
             logger.debug("消息中包含关键词，触发回复")
             return True
         
-        # 获取回复方法
-        method = frequency_config.get("method", "概率回复")
-        
         # 根据不同方法判断
-        if method == "概率回复":
-            prob_config = frequency_config.get("probability", {})
-            probability = prob_config.get("probability", 0.1)
+        if policy.method == "概率回复":
+            probability = policy.get_probability(is_private_chat, group_id)
             
             # 使用概率计算是否回复
             should_reply = random.random() < probability
@@ -90,54 +149,68 @@ class ReplyDecision:
                 logger.debug(f"概率回复未触发，当前概率: {probability}")
             return should_reply
         
+        if policy.method == "自适应回复":
+            # 按最近的消息频率调整概率，活跃的聊天降低概率，冷清的聊天提高概率
+            message_rate = ReplyDecision._message_rates.get_rate(chat_key, policy.activity_window)
+            probability = policy.get_adaptive_probability(message_rate)
+
+            should_reply = random.random() < probability
+            logger.debug(f"自适应回复{'触发' if should_reply else '未触发'}，"
+                         f"当前消息频率: {message_rate * 3600:.1f}条/小时，概率: {probability:.3f}")
+            return should_reply
+
         # 为未来扩展预留接口
         # 可以在这里添加更多回复方法的判断逻辑
         
         return False
-    
+
     @staticmethod
-    def _check_keywords(event: AstrMessageEvent, keywords: list) -> bool:
+    def _match_keywords(event: AstrMessageEvent, policy: ReplyPolicy) -> KeywordMatch:
         """
-        检查消息是否包含关键词
+        检查消息是否包含触发关键词和黑名单关键词
         
         Args:
             event: 消息事件
-            keywords: 关键词列表
+            policy: 回复策略
             
         Returns:
-            是否包含关键词
+            关键词匹配结果
         """
-        # 获取消息文本
+        matcher = policy.matcher
+        if not matcher.keywords and not matcher.blacklist_keywords:
+            return KeywordMatch(False, False)
+
+        # 获取消息文本，只获取一次
         message_text = event.get_message_outline()
-        
-        # 检查是否包含关键词
-        for keyword in keywords:
-            if keyword in message_text:
-                return True
-                
-        return False
-        
+        return matcher.scan(message_text)
+
     @staticmethod
-    def _check_blacklist_keywords(event: AstrMessageEvent, blacklist_keywords: list) -> bool:
+    async def _wait_for_quiet(chat_key: str, policy: ReplyPolicy) -> None:
         """
-        检查消息是否包含黑名单关键词
-        
+        等待聊天中安静时间内没有新消息，或达到最长等待时间
+
+        等待期间该聊天的新消息由 should_reply 推迟截止时间，不会单独触发回复
+
         Args:
-            event: 消息事件
-            blacklist_keywords: 黑名单关键词列表
-            
-        Returns:
-            是否包含黑名单关键词
+            chat_key: 聊天的唯一标识
+            policy: 回复策略
         """
-        # 获取消息文本
-        message_text = event.get_message_outline()
-        
-        # 检查是否包含黑名单关键词
-        for keyword in blacklist_keywords:
-            if keyword in message_text:
-                return True
-                
-        return False
+        now = time.monotonic()
+        pending = {"started": now, "last_message": now, "merged": 0}
+        ReplyDecision._debounce_pending[chat_key] = pending
+        try:
+            while True:
+                deadline = min(pending["last_message"] + policy.debounce_window,
+                               pending["started"] + policy.debounce_max_wait)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                await asyncio.sleep(remaining)
+        finally:
+            ReplyDecision._debounce_pending.pop(chat_key, None)
+
+        logger.debug(f"聊天{chat_key}消息已平息，等待{time.monotonic() - pending['started']:.1f}秒，"
+                     f"合并了{pending['merged']}条消息")
 
     @staticmethod
     async def process_and_reply(event: AstrMessageEvent, config: AstrBotConfig, context: Context):
@@ -161,7 +234,14 @@ class ReplyDecision:
         LLMUtils.set_llm_in_progress(platform_name, is_private, chat_id)
         
         try:
-            # 调用大模型并发送回复
+            # 防抖模式下等待消息平息后再调用大模型
+            policy = ReplyDecision.get_policy(config)
+            if policy.debounce_window:
+                chat_key = LLMUtils.get_chat_key(platform_name, is_private, chat_id)
+                await ReplyDecision._wait_for_quiet(chat_key, policy)
+
+            # 调用大模型并发送回复，标记为主动回复以便统计token用量
+            ReplyScheduler.mark_active_reply(event)
             yield await LLMUtils.call_llm(event, config, context)
         finally:
             # 标记处理完成
@@ -0,0 +1,159 @@
+from astrbot.api.all import *
+from dataclasses import dataclass, field
+from types import MappingProxyType
+from typing import FrozenSet, Mapping, Optional
+from .keyword_matcher import KeywordMatcher
+
+@dataclass(frozen=True)
+class ReplyPolicy:
+    """
+    编译后的回复策略
+
+    由配置一次性编译得到，创建后不再修改。配置变化时编译新的策略并整体替换，
+    决策过程中只读取当前策略的字段，不再逐层查询配置字典或遍历群聊列表
+    """
+
+    # 启用回复的群聊
+    enabled_groups: FrozenSet[str] = frozenset()
+    # 是否启用私聊回复
+    enabled_private: bool = False
+    # 回复方法
+    method: str = "概率回复"
+    # 默认回复概率
+    probability: float = 0.1
+    # 单独设置了回复概率的群聊，格式: {group_id: probability}
+    group_probabilities: Mapping[str, float] = field(default_factory=lambda: MappingProxyType({}))
+    # 自适应回复的目标每小时回复次数
+    target_replies_per_hour: float = 6.0
+    # 自适应回复统计消息频率的时间窗口（秒）
+    activity_window: float = 600.0
+    # 触发关键词和黑名单关键词的匹配器
+    matcher: KeywordMatcher = field(default_factory=KeywordMatcher)
+    # 每个聊天每分钟最多回复次数，0表示不限制
+    chat_replies_per_minute: float = 0.0
+    # 所有聊天合计每分钟最多回复次数，0表示不限制
+    global_replies_per_minute: float = 0.0
+    # 令牌桶容量，即允许连续回复的次数
+    burst: int = 1
+    # 每次回复后的冷却时间（秒）
+    cooldown: float = 0.0
+    # 每日token预算，0表示不限制
+    daily_token_budget: int = 0
+    # 防抖等待的安静时间（秒），0表示不防抖
+    debounce_window: float = 0.0
+    # 防抖最长等待时间（秒）
+    debounce_max_wait: float = 0.0
+
+    @staticmethod
+    def compile(config: AstrBotConfig) -> "ReplyPolicy":
+        """
+        从配置编译回复策略
+
+        Args:
+            config: 配置对象
+
+        Returns:
+            回复策略
+        """
+        frequency_config = config.get("model_frequency", {})
+        prob_config = frequency_config.get("probability", {})
+        adaptive_config = frequency_config.get("adaptive", {})
+        rate_config = frequency_config.get("rate_limit", {})
+        debounce_config = frequency_config.get("debounce", {})
+
+        debounce_window = 0.0
+        if debounce_config.get("enabled", False):
+            debounce_window = ReplyPolicy._non_negative(debounce_config.get("quiet_window", 1.5))
+
+        group_probabilities = {}
+        for item in prob_config.get("group_probabilities", []) or []:
+            # 格式: 群号:概率
+            group_id, sep, value = str(item).rpartition(":")
+            try:
+                if not sep or not group_id.strip():
+                    raise ValueError
+                group_probabilities[group_id.strip()] = ReplyPolicy._clamp_probability(float(value))
+            except ValueError:
+                logger.warning(f"无法解析群聊回复概率配置: {item}，格式应为 群号:概率")
+
+        return ReplyPolicy(
+            enabled_groups=frozenset(str(group_id) for group_id in config.get("enabled_groups", []) or []),
+            enabled_private=bool(config.get("enabled_private", False)),
+            method=frequency_config.get("method", "概率回复"),
+            probability=ReplyPolicy._clamp_probability(prob_config.get("probability", 0.1)),
+            group_probabilities=MappingProxyType(group_probabilities),
+            target_replies_per_hour=ReplyPolicy._non_negative(adaptive_config.get("replies_per_hour", 6)),
+            activity_window=max(1.0, ReplyPolicy._non_negative(adaptive_config.get("window_minutes", 10)) * 60),
+            matcher=KeywordMatcher(
+                frequency_config.get("keywords", []) or [],
+                frequency_config.get("blacklist_keywords", []) or []
+            ),
+            chat_replies_per_minute=ReplyPolicy._non_negative(rate_config.get("chat_replies_per_minute", 0)),
+            global_replies_per_minute=ReplyPolicy._non_negative(rate_config.get("global_replies_per_minute", 0)),
+            burst=max(1, int(ReplyPolicy._non_negative(rate_config.get("burst", 1)))),
+            cooldown=ReplyPolicy._non_negative(rate_config.get("cooldown", 0)),
+            daily_token_budget=int(ReplyPolicy._non_negative(rate_config.get("daily_token_budget", 0))),
+            debounce_window=debounce_window,
+            debounce_max_wait=max(debounce_window, ReplyPolicy._non_negative(debounce_config.get("max_wait", 6))),
+        )
+
+    @staticmethod
+    def _clamp_probability(value) -> float:
+        """将概率限制在0-1之间"""
+        try:
+            return min(max(float(value), 0.0), 1.0)
+        except (TypeError, ValueError):
+            return 0.0
+
+    @staticmethod
+    def _non_negative(value) -> float:
+        """将数值限制为非负数，无法解析时视为0"""
+        try:
+            return max(float(value), 0.0)
+        except (TypeError, ValueError):
+            return 0.0
+
+    def get_adaptive_probability(self, message_rate: float) -> float:
+        """
+        按消息频率计算自适应回复的概率，使回复次数接近目标每小时回复次数
+
+        Args:
+            message_rate: 聊天的消息频率（条/秒）
+
+        Returns:
+            回复概率
+        """
+        messages_per_hour = message_rate * 3600
+        if messages_per_hour <= 0:
+            return 1.0 if self.target_replies_per_hour else 0.0
+        return self._clamp_probability(self.target_replies_per_hour / messages_per_hour)
+
+    def is_enabled(self, is_private_chat: bool, group_id: Optional[str]) -> bool:
+        """
+        判断聊天是否启用回复
+
+        Args:
+            is_private_chat: 是否为私聊
+            group_id: 群聊ID，私聊时忽略
+
+        Returns:
+            是否启用
+        """
+        if is_private_chat:
+            return self.enabled_private
+        return str(group_id) in self.enabled_groups
+
+    def get_probability(self, is_private_chat: bool, group_id: Optional[str]) -> float:
+        """
+        获取聊天的回复概率，群聊单独设置的概率优先
+
+        Args:
+            is_private_chat: 是否为私聊
+            group_id: 群聊ID，私聊时忽略
+
+        Returns:
+            回复概率
+        """
+        if is_private_chat:
+            return self.probability
+        return self.group_probabilities.get(str(group_id), self.probability)
@@ -0,0 +1,205 @@
+from astrbot.api.all import *
+from typing import Any, Dict, Optional
+import threading
+import time
+from .llm_utils import LLMUtils
+from .reply_policy import ReplyPolicy
+
+class _TokenBucket:
+    """令牌桶，按固定速率补充令牌，每次回复消耗一个"""
+
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens: float, now: float):
+        self.tokens = tokens
+        self.updated = now
+
+    def refill(self, rate: float, capacity: float, now: float) -> None:
+        """
+        按经过的时间补充令牌
+
+        Args:
+            rate: 每秒补充的令牌数
+            capacity: 桶的容量
+            now: 当前时间(单调时钟)
+        """
+        elapsed = now - self.updated
+        if elapsed > 0:
+            self.tokens = min(capacity, self.tokens + elapsed * rate)
+        self.updated = now
+
+
+class ReplyScheduler:
+    """
+    回复限流工具类
+
+    每个聊天和全局各有一个令牌桶，按每分钟回复次数补充令牌，两个桶都有令牌时才允许回复；
+    同一聊天上次调用大模型后的冷却时间内不回复，当天消耗的token达到预算后不再主动回复
+    限流参数由回复策略提供，配置变化后随策略一起替换
+    """
+
+    # 每个聊天的令牌桶，格式: {chat_key: _TokenBucket}
+    _buckets: Dict[str, _TokenBucket] = {}
+    # 全局令牌桶
+    _global_bucket: Optional[_TokenBucket] = None
+    # 当天的日期和已消耗的token数
+    _usage_day: str = ""
+    _usage_tokens: int = 0
+    _stats: Dict[str, int] = {
+        "granted": 0,           # 允许回复的次数
+        "rate_limited": 0,      # 因每分钟回复次数限制跳过的次数
+        "cooldown": 0,          # 因冷却时间跳过的次数
+        "budget_exhausted": 0,  # 因token预算用完跳过的次数
+        "responses": 0,         # 记录了token用量的大模型回复数
+    }
+    _lock = threading.Lock()
+
+    # 标记由本插件主动回复发起的大模型请求，只有这些请求的token计入预算
+    ACTIVE_REPLY_EXTRA = "spectrecore_active_reply"
+
+    @staticmethod
+    def try_acquire(platform_name: str, is_private_chat: bool, chat_id: str, policy: ReplyPolicy) -> bool:
+        """
+        检查限流并为一次回复消耗令牌，在决定回复后调用
+
+        Args:
+            platform_name: 平台名称
+            is_private_chat: 是否为私聊
+            chat_id: 聊天ID
+            policy: 回复策略
+
+        Returns:
+            是否允许回复
+        """
+        chat_key = LLMUtils.get_chat_key(platform_name, is_private_chat, chat_id)
+
+        with ReplyScheduler._lock:
+            stats = ReplyScheduler._stats
+
+            # 检查每日token预算
+            if policy.daily_token_budget and ReplyScheduler._get_tokens_today() >= policy.daily_token_budget:
+                stats["budget_exhausted"] += 1
+                logger.debug(f"今日token预算已用完，不进行回复")
+                return False
+
+            # 检查回复后的冷却时间，基于大模型调用状态中的最后调用时间
+            if policy.cooldown:
+                last_call_time = LLMUtils.get_last_call_time(platform_name, is_private_chat, chat_id)
+                if last_call_time is not None and time.time() - last_call_time < policy.cooldown:
+                    stats["cooldown"] += 1
+                    logger.debug(f"聊天{chat_key}仍在回复冷却中，不进行回复")
+                    return False
+
+            # 两个令牌桶都有令牌时才同时扣除，避免一个桶被白白消耗
+            now = time.monotonic()
+            chat_bucket = ReplyScheduler._take_bucket(chat_key, policy.chat_replies_per_minute, policy.burst, now)
+            global_bucket = None
+            if policy.global_replies_per_minute:
+                if ReplyScheduler._global_bucket is None:
+                    ReplyScheduler._global_bucket = _TokenBucket(policy.burst, now)
+                global_bucket = ReplyScheduler._global_bucket
+                global_bucket.refill(policy.global_replies_per_minute / 60, policy.burst, now)
+
+            if (chat_bucket and chat_bucket.tokens < 1) or (global_bucket and global_bucket.tokens < 1):
+                stats["rate_limited"] += 1
+                logger.debug(f"聊天{chat_key}超出回复频率限制，不进行回复")
+                return False
+
+            if chat_bucket:
+                chat_bucket.tokens -= 1
+            if global_bucket:
+                global_bucket.tokens -= 1
+            stats["granted"] += 1
+            return True
+
+    @staticmethod
+    def _take_bucket(chat_key: str, replies_per_minute: float, capacity: int, now: float) -> Optional[_TokenBucket]:
+        """获取并补充聊天的令牌桶，未限制回复次数时返回None"""
+        if not replies_per_minute:
+            ReplyScheduler._buckets.pop(chat_key, None)
+            return None
+
+        bucket = ReplyScheduler._buckets.get(chat_key)
+        if bucket is None:
+            bucket = ReplyScheduler._buckets[chat_key] = _TokenBucket(capacity, now)
+        else:
+            bucket.refill(replies_per_minute / 60, capacity, now)
+        return bucket
+
+    @staticmethod
+    def _get_tokens_today() -> int:
+        """获取当天已消耗的token数，跨天时清零，调用时需持有锁"""
+        today = time.strftime("%Y-%m-%d")
+        if ReplyScheduler._usage_day != today:
+            ReplyScheduler._usage_day = today
+            ReplyScheduler._usage_tokens = 0
+        return ReplyScheduler._usage_tokens
+
+    @staticmethod
+    def mark_active_reply(event: AstrMessageEvent) -> None:
+        """
+        标记事件的大模型请求由主动回复发起
+
+        Args:
+            event: 消息事件
+        """
+        event.set_extra(ReplyScheduler.ACTIVE_REPLY_EXTRA, True)
+
+    @staticmethod
+    def is_active_reply(event: AstrMessageEvent) -> bool:
+        """
+        判断事件的大模型请求是否由主动回复发起
+
+        Args:
+            event: 消息事件
+
+        Returns:
+            是否为主动回复
+        """
+        return bool(event.get_extra(ReplyScheduler.ACTIVE_REPLY_EXTRA))
+
+    @staticmethod
+    def get_token_usage(response: Any) -> int:
+        """
+        从大模型回复中读取消耗的token数
+
+        Args:
+            response: LLMResponse 对象
+
+        Returns:
+            消耗的token总数，提供商未返回用量时为0
+        """
+        usage = getattr(response, "usage", None)
+        if usage is not None and hasattr(usage, "total"):
+            return int(usage.total or 0)
+
+        # 旧版本AstrBot只在原始回复中提供用量
+        raw_usage = getattr(getattr(response, "raw_completion", None), "usage", None)
+        return int(getattr(raw_usage, "total_tokens", 0) or 0)
+
+    @staticmethod
+    def record_usage(tokens: int) -> None:
+        """
+        记录一次主动回复消耗的token数
+
+        Args:
+            tokens: 消耗的token数
+        """
+        with ReplyScheduler._lock:
+            ReplyScheduler._get_tokens_today()
+            ReplyScheduler._usage_tokens += max(0, tokens)
+            ReplyScheduler._stats["responses"] += 1
+
+    @staticmethod
+    def get_stats() -> Dict[str, int]:
+        """
+        获取限流的统计指标
+
+        Returns:
+            统计指标字典，包含允许和跳过的回复次数、当天消耗的token数等
+        """
+        with ReplyScheduler._lock:
+            stats = dict(ReplyScheduler._stats)
+            stats["tokens_today"] = ReplyScheduler._get_tokens_today()
+            stats["chats"] = len(ReplyScheduler._buckets)
+        return stats